@@ -7,24 +7,312 @@ This module is a library of reusable, extendable widgets.
 
 
 import os
+import re
+import bisect
+from collections import defaultdict
+import numpy as np
 from PySide2 import QtCore, QtWidgets
 
 
+# #############################################################################
+# # MODELS
+# #############################################################################
+class FileListModel(QtCore.QAbstractListModel):
+    """
+    A flat list of file names for a ``QListView``, meant to scale to folders
+    with hundreds of thousands of files: the names are kept as plain strings
+    (optionally in natural order, see ``natural_key``), rows are given to the
+    view in batches of ``FETCH_BATCH`` as it scrolls, and searching by prefix
+    or substring runs on a single string with all the names.
+    """
+    FETCH_BATCH = 1000
+    NUM_DIGITS = 20  # numbers up to this many digits sort numerically
+    _DIGITS_RE = re.compile(r"[0-9]+")
+    _MATCH_TYPE_MASK = 0x0F  # Qt::MatchTypeFlag values
+
+    def __init__(self, parent=None, sort=True):
+        """
+        :param sort: If true, names are kept in natural order. Otherwise, in
+          order of addition.
+        """
+        super().__init__(parent)
+        self.sort = sort
+        self.names = []
+        self._keys = []  # natural keys of the names, if sorted
+        self._num_fetched = 0
+        self._search_index = None  # built on demand, see _build_search_index
+
+    @classmethod
+    def natural_key(cls, name):
+        """
+        :returns: A string that sorts like ``name`` case-insensitively, but
+          with the numbers sorted by value (e.g. ``img_2`` before ``img_10``).
+        """
+        padded = cls._DIGITS_RE.sub(lambda m: m.group().zfill(cls.NUM_DIGITS),
+                                    name.lower())
+        # ties, e.g. img_01 and img_1, are broken by the name itself
+        return padded + "\0" + name
+
+    # QT INTERFACE
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        """
+        Only the fetched rows are visible.
+        """
+        return 0 if parent.isValid() else self._num_fetched
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        """
+        """
+        if role == QtCore.Qt.DisplayRole and index.isValid():
+            return self.names[index.row()]
+        return None
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        """
+        """
+        return not parent.isValid() and self._num_fetched < len(self.names)
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        """
+        """
+        if self.canFetchMore(parent):
+            self.fetch_until(self._num_fetched + self.FETCH_BATCH - 1)
+
+    def match(self, start, role, value, hits=1, flags=None):
+        """
+        Overriden to use ``find`` for the case-insensitive searches by prefix
+        or substring, like the keyboard search of the view. Other searches
+        are handled by Qt.
+        """
+        qt = QtCore.Qt
+        flags = (int(qt.MatchStartsWith) | int(qt.MatchWrap) if flags is None
+                 else int(flags))
+        match_type = flags & self._MATCH_TYPE_MASK
+        if role != qt.DisplayRole or flags & int(qt.MatchCaseSensitive) or \
+           match_type not in (int(qt.MatchStartsWith), int(qt.MatchContains)):
+            return super().match(start, role, value, hits,
+                                 qt.MatchFlags(flags))
+        rows = self.find(str(value),
+                         prefix=(match_type == int(qt.MatchStartsWith)))
+        first = bisect.bisect_left(rows, start.row())
+        rows = rows[first:] + (rows[:first] if flags & int(qt.MatchWrap)
+                               else [])
+        if hits >= 0:
+            rows = rows[:hits]
+        if rows:
+            self.fetch_until(max(rows))
+        return [self.index(r) for r in rows]
+
+    # PYTHON INTERFACE
+    def __len__(self):
+        """
+        :returns: The total number of names, fetched or not.
+        """
+        return len(self.names)
+
+    def fetch_until(self, row):
+        """
+        Makes sure that the rows up to the given one (included) are visible.
+        """
+        row = min(row, len(self.names) - 1)
+        if row >= self._num_fetched:
+            self.beginInsertRows(QtCore.QModelIndex(), self._num_fetched, row)
+            self._num_fetched = row + 1
+            self.endInsertRows()
+
+    def set_names(self, names):
+        """
+        Replaces all the names.
+        """
+        self.beginResetModel()
+        if self.sort:
+            self._keys = sorted(self.natural_key(n) for n in names)
+            self.names = [k[k.index("\0") + 1:] for k in self._keys]
+        else:
+            self.names = list(names)
+        self._num_fetched = min(len(self.names), self.FETCH_BATCH)
+        self._search_index = None
+        self.endResetModel()
+
+    def add_names(self, names):
+        """
+        Inserts the given names. Rows already shown by the view are kept.
+        """
+        for name in names:
+            if self.sort:
+                key = self.natural_key(name)
+                row = bisect.bisect(self._keys, key)
+                self._keys.insert(row, key)
+            else:
+                row = len(self.names)
+            if row < self._num_fetched or \
+               self._num_fetched == len(self.names):
+                self.beginInsertRows(QtCore.QModelIndex(), row, row)
+                self.names.insert(row, name)
+                self._num_fetched += 1
+                self.endInsertRows()
+            else:
+                self.names.insert(row, name)
+        self._search_index = None
+
+    def remove_names(self, names):
+        """
+        Removes the given names, if present.
+        """
+        for name in names:
+            row = self.row(name)
+            if row < 0:
+                continue
+            if self.sort:
+                del self._keys[row]
+            if row < self._num_fetched:
+                self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+                del self.names[row]
+                self._num_fetched -= 1
+                self.endRemoveRows()
+            else:
+                del self.names[row]
+        self._search_index = None
+
+    def name(self, row):
+        """
+        :returns: The name at the given row (fetched or not), or ``None`` if
+          out of range.
+        """
+        return self.names[row] if 0 <= row < len(self.names) else None
+
+    def row(self, name):
+        """
+        :returns: The row of the given name (fetched or not), or -1 if not
+          present.
+        """
+        if self.sort:
+            key = self.natural_key(name)
+            row = bisect.bisect_left(self._keys, key)
+            found = row < len(self._keys) and self._keys[row] == key
+            return row if found else -1
+        try:
+            return self.names.index(name)
+        except ValueError:
+            return -1
+
+    def _build_search_index(self):
+        """
+        :returns: A tuple ``(text, starts)``, where ``text`` is a string with
+          all the lowercase names preceded by a newline, and the name at row
+          ``i`` begins after the newline at ``starts[i]``.
+        """
+        if self._search_index is None:
+            lower = [n.lower() for n in self.names]
+            starts = np.zeros(len(lower) + 1, dtype=np.int64)
+            np.cumsum([len(n) + 1 for n in lower], out=starts[1:])
+            text = "".join("\n" + n for n in lower)
+            self._search_index = (text, starts)
+        return self._search_index
+
+    def find(self, text, prefix=False):
+        """
+        :param prefix: If true, matches the names that start with ``text``.
+          Otherwise, the ones that contain it.
+        :returns: A sorted list with the matching rows (fetched or not).
+          The search is case-insensitive.
+        """
+        text = text.lower()
+        if not text or "\n" in text:
+            return []
+        all_text, starts = self._build_search_index()
+        pattern = re.escape(("\n" if prefix else "") + text)
+        positions = [m.start() for m in re.finditer(pattern, all_text)]
+        rows = np.searchsorted(starts, positions, side="right") - 1
+        return np.unique(rows).tolist()
+
+
+class StemIndex:
+    """
+    Maps stems to the file names that begin with them, to pair files by
+    name. Stems are case-insensitive, and end before a ``.`` or at the end
+    of the name. For example, ``img_1`` is a stem of ``IMG_1.png`` and
+    ``img_1.png_annot.png``, but not of ``img_10.png`` or ``img_1_2.png``.
+    """
+    _BOUNDARY_RE = re.compile(r"\.")
+
+    def __init__(self, names=()):
+        """
+        """
+        self._index = defaultdict(set)
+        for name in names:
+            self.add(name)
+
+    @classmethod
+    def stems(cls, name):
+        """
+        :returns: A set with all the stems of ``name``.
+        """
+        lower = name.lower()
+        stems = {lower[:m.start()] for m in cls._BOUNDARY_RE.finditer(lower)}
+        stems.add(lower)
+        stems.discard("")
+        return stems
+
+    @staticmethod
+    def image_stem(img_name):
+        """
+        :returns: The stem used to pair files with the given image, i.e. its
+          lowercase name without extension.
+        """
+        return os.path.splitext(img_name)[0].lower()
+
+    def add(self, name):
+        """
+        """
+        for stem in self.stems(name):
+            self._index[stem].add(name)
+
+    def remove(self, name):
+        """
+        """
+        for stem in self.stems(name):
+            names = self._index.get(stem)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._index[stem]
+
+    def get(self, stem):
+        """
+        :returns: A set with the names that have the given stem.
+        """
+        return set(self._index.get(stem, ()))
+
+
 # #############################################################################
 # # BASIC WIDGETS
 # #############################################################################
 class FileList(QtWidgets.QWidget):
     """
     A file dialog button followed by a list that shows the files in the
-    selected folder.
+    selected folder. The list follows the changes in the folder: they are
+    gathered for ``REFRESH_DELAY_MS``, and then only the added and removed
+    files are updated.
+
+    The list is a ``QListView`` of a ``FileListModel``, so it can handle
+    very large folders. Double clicking a file emits ``itemDoubleClicked``
+    with its name.
     """
+    REFRESH_DELAY_MS = 300
+
+    itemDoubleClicked = QtCore.Signal(str)
+
     def __init__(self, label, parent=None,
-                 default_path=None, extensions=None, sort=True):
+                 default_path=None, extensions=None, sort=True,
+                 pair_suffixes=()):
         """
         :param extensions: A list of string terminations to match, or ``None``
           for match-all.
+        :param pair_suffixes: See ``set_selected_image``.
         :param default_path: If None, 'home' is picked as default.
         :param sort: If true, contents will always be shown sorted
+          (naturally, see ``FileListModel.natural_key``).
         """
         super().__init__(parent)
         self.sort = sort
@@ -32,44 +320,180 @@ class FileList(QtWidgets.QWidget):
                         else default_path)
         self.extensions = [""] if extensions is None else extensions
         self.label = label
+        self.selected_image = None
+        self.pair_suffixes = list(pair_suffixes)
+        self._all_names = None  # listed files, regardless of selected_image
+        self.stem_index = StemIndex()
         # create widgets
         self.file_button = QtWidgets.QPushButton(self.label)
-        self.file_list = QtWidgets.QListWidget()
+        self.model = FileListModel(self, sort)
+        self.file_list = QtWidgets.QListView()
+        self.file_list.setModel(self.model)
+        self.file_list.setUniformItemSizes(True)
+        self.file_list.setEditTriggers(
+            QtWidgets.QAbstractItemView.NoEditTriggers)
         # add widgets to layout
         self.main_layout = QtWidgets.QVBoxLayout(self)
         self.main_layout.addWidget(self.file_button)
         self.main_layout.addWidget(self.file_list)
         # connect
         self.file_button.pressed.connect(self._file_dialog_handler)
-        # track filesystem changes
+        self.file_list.doubleClicked.connect(
+            lambda idx: self.itemDoubleClicked.emit(
+                self.model.name(idx.row())))
+        # track filesystem changes. Events arriving while the timer is active
+        # are handled by the same refresh
+        self._refresh_timer = QtCore.QTimer(self)
+        self._refresh_timer.setSingleShot(True)
+        self._refresh_timer.setInterval(self.REFRESH_DELAY_MS)
+        self._refresh_timer.timeout.connect(self.refresh)
         self.file_watcher = QtCore.QFileSystemWatcher()
-        self.file_watcher.fileChanged.connect(
-            lambda: self.update_path(self.dirpath))
-        self.file_watcher.directoryChanged.connect(
-            lambda: self.update_path(self.dirpath))
+        self.file_watcher.fileChanged.connect(self._schedule_refresh)
+        self.file_watcher.directoryChanged.connect(self._schedule_refresh)
 
-    def update_path(self, dirname,selected_image=None):
+    def _list_dir(self, dirname):
         """
-        :param str dirname: The new directory path to be listed.
-        :param selected_images: The name of an image with which the list can be filtered
+        :returns: A set with the names of the files in ``dirname`` that
+          match the extensions.
         """
-        if selected_image is None:
-            file_names = [f for f in os.listdir(dirname)
-                          if f.lower().endswith(tuple(self.extensions))]
-        else:
-            file_names = [f for f in os.listdir(dirname)
-                          if f.lower().endswith(tuple(self.extensions))
-                          and selected_image.lower() in f.lower()]
+        extensions = tuple(self.extensions)
+        with os.scandir(dirname) as entries:
+            return {e.name for e in entries
+                    if e.name.lower().endswith(extensions) and e.is_file()}
+
+    def _pair_stems(self, img_name):
+        """
+        :returns: A set with the stems of the files paired with the given
+          image name, see ``set_selected_image``.
+        """
+        stem = StemIndex.image_stem(img_name)
+        stems = {stem + os.path.splitext(suff)[0].lower()
+                 for suff in self.pair_suffixes}
+        stems.add(stem)
+        return stems
+
+    def _is_shown(self, name):
+        """
+        :returns: Whether the given file passes the ``selected_image``
+          filter.
+        """
+        return (self.selected_image is None or not StemIndex.stems(
+            name).isdisjoint(self._pair_stems(self.selected_image)))
 
-        self.file_list.clear()
-        self.file_list.addItems(file_names)
+    def _shown_names(self):
+        """
+        :returns: The listed names that pass the ``selected_image`` filter.
+        """
+        if self.selected_image is None:
+            return self._all_names
+        return self._paired(self.selected_image)
+
+    def _paired(self, img_name):
+        """
+        :returns: A set with the listed names paired with the given image.
+        """
+        names = set()
+        for stem in self._pair_stems(img_name):
+            names.update(self.stem_index.get(stem))
+        return names
+
+    def update_path(self, dirname, selected_image=None):
+        """
+        :param str dirname: The new directory path to be listed.
+        :param selected_images: If given, only the files paired with this
+          image name are shown, see ``set_selected_image``.
+        """
+        self.selected_image = selected_image
+        self._all_names = self._list_dir(dirname)
+        self.stem_index = StemIndex(self._all_names)
+        self.model.set_names(self._shown_names())
         #
         self.file_watcher.removePath(self.dirpath)
         self.file_watcher.addPath(dirname)
         #
         self.dirpath = dirname
-        if self.sort:
-            self.file_list.sortItems(QtCore.Qt.AscendingOrder)
+
+    def set_selected_image(self, selected_image):
+        """
+        Shows only the files paired with the given image name, i.e. the ones
+        whose name begins with the image name (without extension), followed
+        by a ``.`` or by any of the ``pair_suffixes`` (without extension).
+        E.g. ``img_1.png`` is paired with ``img_1.npz`` and
+        ``img_1.png_annot.png``, and with ``img_1_annot.png`` if
+        ``"_annot.png"`` is a pair suffix, but not with ``img_10.png`` or
+        ``img_1_2.png``. If ``None``, all files are shown.
+
+        The directory is not listed again, only the ``stem_index``.
+        """
+        if self._all_names is None:
+            self.update_path(self.dirpath, selected_image)
+            return
+        self.selected_image = selected_image
+        self.model.set_names(self._shown_names())
+
+    def paired_names(self, img_name):
+        """
+        :returns: A set with the listed names paired with the given image
+          name (see ``set_selected_image``), regardless of the one currently
+          selected. No disk access needed, unless not listed yet.
+        """
+        if self._all_names is None:
+            self.update_path(self.dirpath, self.selected_image)
+        return self._paired(img_name)
+
+    def set_pair_suffixes(self, pair_suffixes):
+        """
+        Sets the ``pair_suffixes`` (see ``set_selected_image``), updating the
+        shown files if needed.
+        """
+        pair_suffixes = list(pair_suffixes)
+        if pair_suffixes != self.pair_suffixes:
+            self.pair_suffixes = pair_suffixes
+            if self._all_names is not None:
+                self.model.set_names(self._shown_names())
+
+    def _schedule_refresh(self):
+        """
+        """
+        if not self._refresh_timer.isActive():
+            self._refresh_timer.start()
+
+    def refresh(self):
+        """
+        Lists the current directory again, and adds/removes the files that
+        changed since the last listing. The rest of the list, including the
+        selection, is left untouched.
+        """
+        if self._all_names is None:
+            return
+        try:
+            file_names = self._list_dir(self.dirpath)
+        except OSError:
+            # the directory is gone
+            file_names = set()
+        removed = self._all_names - file_names
+        added = file_names - self._all_names
+        self._all_names = file_names
+        for f in removed:
+            self.stem_index.remove(f)
+        for f in added:
+            self.stem_index.add(f)
+        self.model.remove_names(removed)
+        self.model.add_names(f for f in added if self._is_shown(f))
+
+    def current_row(self):
+        """
+        :returns: The row of the current file, or -1 if none.
+        """
+        idx = self.file_list.currentIndex()
+        return idx.row() if idx.isValid() else -1
+
+    def set_current_row(self, row):
+        """
+        Makes the file at the given row current, scrolling to it.
+        """
+        self.model.fetch_until(row)
+        self.file_list.setCurrentIndex(self.model.index(row))
 
     def _file_dialog_handler(self):
         """
@@ -283,6 +707,7 @@ class MaskPaintForm(QtWidgets.QWidget):
         :param slider_visible: If false, the slider will be still there but
           hidden.
         :param activate: Once created, select this item in the radio buttons.
+        :returns: The index of the new item, e.g. for ``thresholds``.
         """
         # sub-layout with 2-row elts: [button, colordialog; label, threshold]
         but = QtWidgets.QRadioButton(name)
@@ -339,12 +764,17 @@ class MaskPaintForm(QtWidgets.QWidget):
             lambda val: self._set_thresh_label(lbl,val,"Upper thresh"))
         sl2.valueChanged.connect(
             lambda val: self._set_thresh_label(lbl2,val,"Lower thresh"))
+        sl.valueChanged.connect(
+            lambda _: self._handle_threshold_slider_moved(sl, sl2))
+        sl2.valueChanged.connect(
+            lambda _: self._handle_threshold_slider_moved(sl, sl2))
         # initialize label
         self._set_thresh_label(lbl, sl.value(),"Upper thresh")
         self._set_thresh_label(lbl2, sl2.value(),"Lower thresh")
         #
         if activate:
             but.click()
+        return len(self._buttons) - 1
 
     def remove_item(self, idx):
         """
@@ -365,6 +795,16 @@ class MaskPaintForm(QtWidgets.QWidget):
         sl.setParent(w)
         lyt.setParent(w)
 
+    def thresholds(self, idx):
+        """
+        :param idx: Index of an element, as returned by ``add_item``.
+        :returns: The ``(upper, lower)`` values of the element's threshold
+          sliders, as passed to ``threshold_slider_changed``.
+        """
+        # each element has 2 sliders, see add_item
+        upper_sl, lower_sl = self._sliders[2 * idx:2 * idx + 2]
+        return upper_sl.value(), lower_sl.value()
+
     def slider_to_p_val(self, sl_val):
         """
         Since the slider goes from 0 to ``thresh_num_steps``, this function
@@ -396,6 +836,17 @@ class MaskPaintForm(QtWidgets.QWidget):
         """
         self.threshold_slider_changed(sl.value(),sl2.value())
 
+    def _handle_threshold_slider_moved(self, sl, sl2):
+        """
+        While any of the sliders is being dragged, the change is only a
+        preview. Otherwise (e.g. keyboard or click on the groove) there won't
+        be a release, so the change is final.
+        """
+        if sl.isSliderDown() or sl2.isSliderDown():
+            self.threshold_slider_moved(sl.value(), sl2.value())
+        else:
+            self.threshold_slider_changed(sl.value(), sl2.value())
+
     def _handle_rgba_box_changed(self, box, r, g, b, a):
         """
         """
@@ -451,6 +902,14 @@ class MaskPaintForm(QtWidgets.QWidget):
         """
         pass
 
+    def threshold_slider_moved(self, t, t2):
+        """
+        Override me! Called instead of ``threshold_slider_changed`` while the
+        user is dragging a threshold slider, so it should be fast. Once the
+        slider is released, ``threshold_slider_changed`` is called.
+        """
+        pass
+
 
 # #############################################################################
 # # SAVING SECTON
@@ -465,6 +924,8 @@ class SaveForm(QtWidgets.QWidget):
     DIALOG_TEXT = "Output\nfolder"
     OVERWRITE_TEXT = "Overwrite\nsaved"
 
+    suffixesChanged = QtCore.Signal()
+
     def __init__(self, parent=None, default_path=None):
         """
         :param str default_path: If not given, 'home' is picked as default.
@@ -494,7 +955,8 @@ class SaveForm(QtWidgets.QWidget):
         self.file_dialog_button.clicked.connect(self._change_save_path)
         self.save_button.clicked.connect(self._handle_save_masks)
 
-    def add_checkbox(self, checkbox_name, initial_val=True, initial_txt=None):
+    def add_checkbox(self, checkbox_name, initial_val=True, initial_txt=None,
+                     tooltip=None):
         """
         Adds an element that can be selected to be saved.
 
@@ -502,10 +964,14 @@ class SaveForm(QtWidgets.QWidget):
         :param initial_txt: The initial suffix to be appended to the files. If
           none is given, the ``checkbox_name`` is picked as default. The user
           can change this from the GUI.
+        :param tooltip: If given, help text shown when hovering the suffix.
         """
         if initial_txt is None:
             initial_txt = checkbox_name
         tb = QtWidgets.QLineEdit(initial_txt)
+        if tooltip is not None:
+            tb.setToolTip(tooltip)
+        tb.textChanged.connect(lambda _: self.suffixesChanged.emit())
         #
         self.save_group.add_box(checkbox_name, False, initial_val)
         self.text_boxes.addWidget(tb)
@@ -523,10 +989,16 @@ class SaveForm(QtWidgets.QWidget):
         """
         states = [s == QtCore.Qt.CheckState.Checked
                   for s in self.save_group.state()]
-        suffixes = [self.text_boxes.itemAt(i).widget().text()
-                    for i in range(self.text_boxes.count())]
         overwrite = self.overwrite_button.isChecked()
-        self.save_masks(states, suffixes, overwrite)
+        self.save_masks(states, self.suffixes(), overwrite)
+
+    def suffixes(self):
+        """
+        :returns: A list with the current suffix of each element, in the
+          order they were added.
+        """
+        return [self.text_boxes.itemAt(i).widget().text()
+                for i in range(self.text_boxes.count())]
 
     def save_masks(self, states, suffixes, overwrite):
         """
@@ -126,6 +126,7 @@ class SavedStateTracker:
         #
         self._has_unsaved_changes = False
         self._has_been_deleted = False
+        self.num_edits = 0
 
     def edit(self):
         """
@@ -135,15 +136,21 @@ class SavedStateTracker:
         # assert not self._has_been_deleted, \
         #     "Deleted tracker cannot be further used! create a new one"
         self._has_unsaved_changes = True
+        self.num_edits += 1
 
-    def save(self, saved_dict=None, ok_dialog_ms=1000):
+    def save(self, saved_dict=None, ok_dialog_ms=1000, num_edits=None):
         """
         Call this any time the state that we want to track has been saved
+
+        :param num_edits: If the saving took a while, the ``num_edits`` at
+          the moment the state was taken. If there were further edits in the
+          meantime, the state still has unsaved changes.
         """
         # bug factory
         # assert not self._has_been_deleted, \
         #     "Deleted tracker cannot be further used! create a new one"
-        self._has_unsaved_changes = False
+        if num_edits is None or num_edits == self.num_edits:
+            self._has_unsaved_changes = False
         if saved_dict is not None:
             self.dialog = SavedInfoDialog(saved_dict, ok_dialog_ms)
             self.dialog.show()
@@ -12,6 +12,10 @@ Check instructions.txt for more details.
 
 
 import os
+import re
+import sys
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from PySide2 import QtCore, QtWidgets, QtGui
 import numpy as np
 from PIL import Image
@@ -22,25 +26,238 @@ from skimage.filters import apply_hysteresis_threshold
 from .dialogs import InstructionsDialog, AboutDialog, KeymapsDialog, \
     SavedStateTracker
 #
-from ..masked_scene import MaskedImageScene, DisplayView
+from ..masked_scene import MaskedImageScene, DisplayView, \
+    IndexedMaskItem
 from ..base_widgets import FileList, MaskPaintForm, SaveForm
-from ..utils import load_img_and_exif, unique_filename
-from ..commands import DrawCommand, EraseCommand, DrawOverlappingCommand
+from ..utils import load_img_and_exif, UniqueFilenameAllocator, \
+    read_img_shape, load_img_preview, load_npz_array, save_bool_arr, \
+    load_bool_arr
+from ..commands import DrawCommand, EraseCommand, DrawOverlappingCommand, \
+    MemoryBudgetUndoStack
 from ..objects import PointList
+from ..workers import PrefetchingLoader, FutureSignaler
 
 
 # #############################################################################
 # ## APPLICATION LOGIC FOR QUICK MASKING
 # #############################################################################
-def pmap_to_mask(pmap,upper_percentile,lower_percentile,percentile_max=100):
-    pmap=np.array(pmap)
-    values = np.sort(pmap[::-1].flatten())
-    up = int((len(values)-1) * upper_percentile /percentile_max)
-    lp= int((len(values)-1) * lower_percentile / percentile_max )
-    pmap[pmap>values[up]]=0
-    pmap[pmap<values[lp]]=0
-    pmap=pmap>0
-    return pmap
+def cutoffs_to_mask(pmap, upper_cutoff, lower_cutoff):
+    """
+    :param pmap: A numerical array of any shape.
+    :param upper_cutoff: Values above this will be false.
+    :param lower_cutoff: Values below this will be false.
+    :returns: A ``np.bool`` array of same shape as ``pmap``, where the values
+      in ``[lower_cutoff, upper_cutoff]`` are true. Non-positive values are
+      always false.
+
+    .. note::
+      The input is not modified nor copied, only compared.
+    """
+    mask = pmap <= upper_cutoff
+    if lower_cutoff > 0:
+        mask &= pmap >= lower_cutoff
+    else:
+        mask &= pmap > 0
+    return mask
+
+
+def ranked_values(pmap, ranks, chunk_size=2 ** 20):
+    """
+    :param pmap: A numerical array of any shape.
+    :param ranks: A list of integers between 0 and ``pmap.size - 1``.
+    :param chunk_size: See ``PercentileThresholder.quantize``.
+    :returns: An array with the values of ``pmap`` at the given ranks, i.e.
+      ``np.sort(pmap, axis=None)[ranks]``.
+
+    For maps of at most 16 bits (e.g. ``np.uint8`` or ``np.float16``), the
+    ranks are found by counting the occurrences of every possible value, so
+    the map is not copied (and memory-mapped maps are read chunk by chunk).
+    Other maps are copied and partitioned around the ranks.
+    """
+    flat = pmap.ravel()
+    if flat.dtype.itemsize > 2 or flat.dtype.kind not in "uif":
+        return np.partition(flat, sorted(set(ranks)))[ranks]
+    # sort all possible bit patterns by value (NaNs go last, as in np.sort)
+    # and count how many elements of the map each sorted position gets
+    bits_dtype = np.dtype("u{}".format(flat.dtype.itemsize))
+    patterns = np.arange(2 ** (8 * flat.dtype.itemsize), dtype=bits_dtype)
+    order = np.argsort(patterns.view(flat.dtype), kind="stable")
+    positions = np.empty_like(patterns)
+    positions[order] = patterns
+    counts = np.zeros(len(patterns), dtype=np.int64)
+    for beg in range(0, flat.size, chunk_size):
+        chunk = flat[beg:beg + chunk_size].view(bits_dtype)
+        counts += np.bincount(positions[chunk], minlength=len(patterns))
+    idxs = np.searchsorted(np.cumsum(counts), ranks, side="right")
+    return patterns[order[idxs]].view(flat.dtype)
+
+
+def pmap_to_mask(pmap, upper_percentile, lower_percentile,
+                 percentile_max=100):
+    """
+    :param pmap: A numerical array of any shape.
+    :param upper_percentile: Values above this percentile will be false.
+    :param lower_percentile: Values below this percentile will be false.
+    :param percentile_max: The value that corresponds to the 100% percentile.
+    :returns: A ``np.bool`` mask, see ``cutoffs_to_mask``.
+
+    One-shot thresholding. It only partitions the values around the 2 needed
+    ranks, but if the same ``pmap`` is thresholded repeatedly, use
+    ``PercentileThresholder`` instead.
+    """
+    last = pmap.size - 1
+    up = int(last * upper_percentile / percentile_max)
+    lp = int(last * lower_percentile / percentile_max)
+    upper_cutoff, lower_cutoff = ranked_values(pmap, [up, lp])
+    return cutoffs_to_mask(pmap, upper_cutoff, lower_cutoff)
+
+
+class PercentileThresholder:
+    """
+    Percentile-based thresholding of a probability map. The quantile table
+    is computed once at construction, so that each ``(upper, lower)``
+    percentile pair is converted into cutoff values in constant time, and the
+    masking itself is a vectorized comparison on the (uncopied) map.
+
+    Usage example::
+
+      thresholder = PercentileThresholder(pmap)
+      mask = thresholder.mask(100, 90)  # top 10% of the values
+    """
+
+    def __init__(self, pmap, percentile_max=100, num_steps=100):
+        """
+        :param pmap: A numerical array of any shape (also memory-mapped, and
+          of any precision). It is referenced, not copied, so it shouldn't be
+          modified afterwards. Note that percentiles don't change if the map
+          is multiplied by a positive factor, so there is no need to
+          normalize it.
+        :param percentile_max: The value that corresponds to the 100%
+          percentile.
+        :param num_steps: Resolution of the quantile table. Percentiles are
+          rounded to the closest of the ``num_steps + 1`` table entries, so
+          with ``num_steps == percentile_max`` integer percentiles are exact.
+        """
+        assert pmap.size > 0, "Empty pmap!"
+        self.pmap = pmap
+        self.percentile_max = percentile_max
+        self.num_steps = num_steps
+        #
+        last = pmap.size - 1
+        ranks = [int(last * i / num_steps) for i in range(num_steps + 1)]
+        self.quantiles = ranked_values(pmap, ranks)
+        # distinct cutoff values that the masks can have. Zero is included
+        # because non-positive values are always false. They keep the dtype
+        # of the map, so comparisons with it don't upcast it
+        self.levels = np.unique(np.append(
+            self.quantiles, np.zeros(1, dtype=self.quantiles.dtype)))
+
+    def cutoff(self, percentile):
+        """
+        :returns: The value of ``pmap`` at the given percentile.
+        """
+        step = round(percentile * self.num_steps / self.percentile_max)
+        step = min(max(step, 0), self.num_steps)
+        return self.quantiles[step]
+
+    def mask(self, upper_percentile, lower_percentile):
+        """
+        :returns: A ``np.bool`` mask with the shape of ``pmap``, see
+          ``cutoffs_to_mask``.
+        """
+        return cutoffs_to_mask(self.pmap, self.cutoff(upper_percentile),
+                               self.cutoff(lower_percentile))
+
+    def quantize(self, code_offset=0, chunk_size=2 ** 20):
+        """
+        :param code_offset: This will be added to all codes.
+        :param chunk_size: The map is quantized by chunks of this many
+          elements, to prevent large temporary arrays.
+        :returns: A ``np.uint8`` array of codes with same shape as ``pmap``.
+          A value between the levels ``i-1`` and ``i`` gets the code ``2i``,
+          and a value equal to level ``i`` gets ``2i+1``. Together with
+          ``code_lut``, this allows to threshold the map without touching it.
+        """
+        num_levels = len(self.levels)
+        assert 2 * num_levels + code_offset < 256, \
+            "Too many levels for uint8 codes! reduce num_steps"
+        flat = self.pmap.ravel()
+        codes = np.empty(flat.shape, dtype=np.uint8)
+        for beg in range(0, flat.size, chunk_size):
+            chunk = flat[beg:beg + chunk_size]
+            idxs = np.searchsorted(self.levels, chunk)
+            is_level = self.levels[np.minimum(idxs, num_levels - 1)] == chunk
+            codes[beg:beg + chunk_size] = 2 * idxs + is_level + code_offset
+        return codes.reshape(self.pmap.shape)
+
+    def release_pmap(self):
+        """
+        Drops the reference to the ``pmap``, so that it can be freed once
+        quantized. Afterwards, ``mask`` and ``quantize`` can't be used, but
+        ``cutoff`` and ``code_lut`` can.
+        """
+        self.pmap = None
+
+    def code_lut(self, upper_percentile, lower_percentile, code_offset=0):
+        """
+        :param code_offset: See ``quantize``.
+        :returns: A ``np.bool(256)`` lookup table, such that
+          ``code_lut(u, l)[quantize()]`` equals ``mask(u, l)``.
+        """
+        upper = self.cutoff(upper_percentile)
+        lower = self.cutoff(lower_percentile)
+        last_code = 2 * np.searchsorted(self.levels, upper) + 1
+        if lower > 0:
+            first_code = 2 * np.searchsorted(self.levels, lower) + 1
+        else:
+            first_code = 2 * (np.searchsorted(self.levels, 0) + 1)
+        lut = np.zeros(256, dtype=np.bool)
+        lut[first_code + code_offset:last_code + code_offset + 1] = True
+        return lut
+
+
+def load_preannot(preannot_path, num_steps=100, npz_field="entropy"):
+    """
+    Loads a preannotation map and prepares it for thresholding. See
+    ``IntegratedDisplayView.preannot_from_path`` for the supported formats.
+    This doesn't involve Qt, so it can run on worker threads.
+
+    :param num_steps: See ``PercentileThresholder``.
+    :param npz_field: Name of the map in ``.npz`` files.
+    :returns: A tuple ``(thresholder, codes)``, where ``thresholder`` is a
+      ``PercentileThresholder`` of the map (already released), and ``codes``
+      its quantization, with ``IndexedMaskItem.NUM_RESERVED_CODES`` offset.
+    """
+    ext = os.path.splitext(preannot_path)[1].lower()
+    if ext == ".npy":
+        pmap = np.load(preannot_path, mmap_mode="r")
+    elif ext == ".npz":
+        pmap = load_npz_array(preannot_path, npz_field)
+    else:
+        with Image.open(preannot_path) as img:
+            pmap = np.asarray(img.getchannel(0))
+    # the sorted order is computed only once per loaded pmap
+    thresholder = PercentileThresholder(pmap, num_steps, num_steps)
+    # the pmap is quantized once into a uint8 map of codes. Thresholding
+    # then only changes which codes are shown
+    codes = thresholder.quantize(IndexedMaskItem.NUM_RESERVED_CODES)
+    thresholder.release_pmap()
+    return thresholder, codes
+
+
+def pick_paired_file(candidates, preferred):
+    """
+    :param candidates: File names that are paired with an image.
+    :param preferred: File names to be picked, in order of preference.
+    :returns: The candidate that matches (case-insensitively) the first
+      possible of the ``preferred`` names, or ``None`` if none matches.
+    """
+    by_lower = {c.lower(): c for c in candidates}
+    for name in preferred:
+        if name.lower() in by_lower:
+            return by_lower[name.lower()]
+    return None
+
 
 # #############################################################################
 # ## WIDGET EXTENSIONS AND COMPOSITIONS TO ADD SPECIFIC LOGIC+LAYOUT
@@ -74,29 +291,48 @@ class IntegratedSaveForm(SaveForm):
     """
     A ``SaveForm`` that implements this app's logic, namely, it features 2
     masks, one for annot and one for preannot, and saves them as B&W png.
+    The format of each mask can be changed via the extension of its suffix,
+    see ``save_bool_arr_as_img``.
     """
+    MASK_SUFFIX_TIP = ("The extension sets the format: .png (B&W image), "
+                       ".npz (packed bits, fastest) or .json (COCO RLE)")
+
     def __init__(self, main_window, default_path=None,
-                 save_dialog_timeout_ms=1000):
+                 save_dialog_timeout_ms=1000, png_compress_level=1):
         """
         :param main_window: A reference to the ``BimaskMainWindow``
         :param str default_path: If non given, 'home' is picked.
         :param save_dialog_timeout: When successfully saving, a dialog
           will pop up, and disappear after this many miliseconds.
+        :param png_compress_level: From 0 (fastest, biggest) to 9 (slowest,
+          smallest), the zlib compression of masks saved as ``.png``.
         """
         super().__init__(None, default_path)
         self.main_window = main_window
+        self.png_compress_level = png_compress_level
         self.add_checkbox("preannot.", initial_val=False,
-                          initial_txt="_preannot.png")
-        self.add_checkbox("annot.", initial_txt="_annot.png")
+                          initial_txt="_preannot.png",
+                          tooltip=self.MASK_SUFFIX_TIP)
+        self.add_checkbox("annot.", initial_txt="_annot.png",
+                          tooltip=self.MASK_SUFFIX_TIP)
         self.add_checkbox("points", initial_txt="_points.json")
         # This reference is needed otherwise dialogs get garbage collected?
         self.dialog = None
         self.dialog_ms = save_dialog_timeout_ms
+        # files are written by a single worker, so saves happen in order
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = FutureSignaler(self)
+        # lists each output folder once, instead of probing every candidate
+        self.unique_filename = UniqueFilenameAllocator()
 
     def save_masks(self, states, suffixes, overwrite):
         """
         Overriden method that we don't call directly. See ``SaveForm`` for
         interface details.
+
+        The masks and points are copied here, and then encoded and written by
+        a background worker, so the GUI doesn't freeze. Once written, the
+        state is marked as saved and the saved info dialog is shown.
         """
         save_preannot, save_annot, save_points = states
         suff_preannot, suff_annot, suff_points = suffixes
@@ -106,45 +342,94 @@ class IntegratedSaveForm(SaveForm):
         pa_pmi = self.main_window.graphics_view.preannot_pmi
         #
         scene = self.main_window.graphics_view.scene()
-        saved = {}
+        masks = []  # (description, path, bool_arr)
         if save_preannot and pa_pmi is not None:
             pa_path = os.path.join(self.save_path, img_name + suff_preannot)
-            if not overwrite:
-                pa_path = unique_filename(pa_path)
-            pa_msk_arr = scene.mask_as_bool_arr(pa_pmi)
-            self.save_bool_arr_as_img(pa_msk_arr, pa_path, overwrite)
-            saved["preannotation mask"] = pa_path
+            masks.append(("preannotation mask", pa_path,
+                          self._snapshot(scene.mask_as_bool_arr(pa_pmi))))
         if save_annot and a_pmi is not None:
             a_path = os.path.join(self.save_path, img_name + suff_annot)
-            if not overwrite:
-                a_path = unique_filename(a_path)
-            msk_arr = scene.mask_as_bool_arr(a_pmi)
-            self.save_bool_arr_as_img(msk_arr, a_path, overwrite)
-            saved["annotation mask"] = a_path
+            masks.append(("annotation mask", a_path,
+                          self._snapshot(scene.mask_as_bool_arr(a_pmi))))
+        points = None  # (description, path, state_dict)
         if save_points and scene.objects:
             state_dict = {k.__name__: [elt.state() for elt in v if elt.state()]
                           for k, v in scene.objects.items()}
             p_path = os.path.join(self.save_path, img_name + suff_points)
-            if not overwrite:
-                p_path = unique_filename(p_path)
-            with open(p_path, "w") as f:
-                # f.write(str(state_dict))
-                json.dump(state_dict, f)
-            saved["point lists"] = p_path
+            points = ("point lists", p_path, state_dict)
         #
-        if saved:
-            self.main_window.graphics_view.saved_state_tracker.save(
-                saved, self.dialog_ms)
+        if masks or points is not None:
+            tracker = self.main_window.graphics_view.saved_state_tracker
+            num_edits = tracker.num_edits
+            fut = self.executor.submit(self._write, masks, points, overwrite)
+            # errors are re-raised in the GUI thread
+            self.futures.watch(fut, lambda saved: tracker.save(
+                saved, self.dialog_ms, num_edits))
+
+    @staticmethod
+    def _snapshot(bool_arr):
+        """
+        Masks may be views that keep changing while being saved, in which
+        case they are copied.
+        """
+        return bool_arr if bool_arr.flags.owndata else bool_arr.copy()
+
+    def _write(self, masks, points, overwrite):
+        """
+        Runs on the worker thread. Writes the output of ``save_masks`` and
+        returns the dictionary of saved paths.
+        """
+        saved = {}
+        for descr, path, arr in masks:
+            if not overwrite:
+                path = self.unique_filename(path)
+            self._write_reserved(
+                path, not overwrite, lambda p: self.save_bool_arr_as_img(
+                    arr, p, overwrite_existing=True))
+            saved[descr] = path
+        if points is not None:
+            descr, path, state_dict = points
+            if not overwrite:
+                path = self.unique_filename(path)
+            self._write_reserved(path, not overwrite,
+                                 lambda p: self._write_json(state_dict, p))
+            saved[descr] = path
+        return saved
+
+    @staticmethod
+    def _write_json(state_dict, path):
+        """
+        """
+        with open(path, "w") as f:
+            json.dump(state_dict, f)
+
+    @staticmethod
+    def _write_reserved(path, is_reserved, write_fn):
+        """
+        Calls ``write_fn(path)``. If the path was reserved as an empty file
+        (see ``UniqueFilenameAllocator``) and writing fails, it is removed.
+        """
+        try:
+            write_fn(path)
+        except Exception:
+            if is_reserved:
+                os.remove(path)
+            raise
 
     def save_bool_arr_as_img(self, arr, outpath, overwrite_existing=False):
         """
-        Output: RGB PNG image where false is black (0, 0, 0) and true is white
-        (255, 255, 255).
+        Output: By default, a 1-bit PNG image where false is black and true
+        is white. If ``outpath`` ends with ``.npz`` or ``.json``, the mask is
+        saved as packed bits or COCO RLE instead, see
+        ``utils.save_bool_arr``. All formats can be loaded back with
+        ``IntegratedDisplayView.mask_from_path``.
+
+        .. note::
+          This is called from a worker thread, see ``save_masks``.
         """
         if not overwrite_existing:
-            outpath = unique_filename(outpath)
-        img = Image.fromarray(arr)
-        img.save(outpath)
+            outpath = self.unique_filename(outpath)
+        save_bool_arr(arr, outpath, self.png_compress_level)
 
 
 class IntegratedDisplayView(DisplayView):
@@ -154,18 +439,39 @@ class IntegratedDisplayView(DisplayView):
     be done on them (painting, updating...), and the callback mechanisms to
     trigger those operations.
     """
-    def __init__(self, main_window, scale_percent=15):
+    def __init__(self, main_window, scale_percent=15, tile_size=512,
+                 img_cache_size=3):
         """
         :param scale_percent: Each zoom in/out operation will scale the view
           by this much (in percent).
+        :param tile_size: See ``MaskedImageScene``. If None, the scene won't
+          be tiled.
+        :param img_cache_size: Number of decoded images (and of paired masks
+          and preannotations) to be kept in memory, see ``prefetch_images``
+          and ``prefetch_pairs``.
         """
         super().__init__(scene=None, parent=None, scale_percent=scale_percent)
-        self._scene = MaskedImageScene()
+        self._scene = MaskedImageScene(tile_size=tile_size)
+        self.img_loader = PrefetchingLoader(
+            lambda path: load_img_and_exif(path)[0], img_cache_size)
+        self.mask_loader = PrefetchingLoader(load_bool_arr, img_cache_size)
+        self.preannot_loader = PrefetchingLoader(
+            functools.partial(load_preannot,
+                              num_steps=main_window.THRESH_NUM_STEPS,
+                              npz_field=main_window.PREANNOT_NPZ_FIELD),
+            img_cache_size)
+        self.futures = FutureSignaler(self)
+        self._img_request = None  # path of the image being loaded, if any
+        self._img_futures = []  # full and preview loads of that image
+        self._mask_colors = None  # (annot, preannot) colors of that image
+        self._pair_request = None  # path of the image whose pairs load
+        self._pair_futures = {}  # pending mask and preannot loads, by kind
+        self._unapplied_pairs = {}  # loaded but not applied, see apply_pairs
         self.main_window = main_window
         self.shape = None
         self.setScene(self._scene)
         #
-        self._preannot_pmap = None
+        self._preannot_thresholder = None
         self.preannot_pmi = None
         self.annot_pmi = None
         #
@@ -176,12 +482,27 @@ class IntegratedDisplayView(DisplayView):
 
     # MEMORY ACTIONS
     def new_image(self, img_path, initial_mask_color=(219, 54, 148, 150),
-                  initial_preannot_color=(102, 214, 123, 100)):
+                  initial_preannot_color=(102, 214, 123, 100),
+                  mask_path=None, preannot_path=None):
         """
         If successful, removes all elements from the scene and the undo stack,
         and loads a fresh image and masks. If there are unsaved changes, a
         dialog asking for confirmation will pop up.
 
+        Unless it was already prefetched, the image is loaded in the
+        background: the (empty) masks are ready immediately, a downscaled
+        preview is shown as soon as possible, and swapped for the full
+        resolution when ready. Loads of prior images that are still pending
+        are cancelled. Until then, the masks can't be edited (see
+        ``is_loading``), and if the load fails, the scene is cleared.
+
+        If ``mask_path`` and/or ``preannot_path`` are given, they are loaded
+        in the background too (see ``mask_from_path`` and
+        ``preannot_from_path``), and applied together once they and the full
+        image are ready. Unlike loading them by hand, this doesn't count as an
+        unsaved change. If the masks were edited in the meantime, they are
+        only applied on request, see ``apply_pairs``.
+
         :returns: True if the action completed successfully, False if the user
           decides to abort.
         """
@@ -191,108 +512,324 @@ class IntegratedDisplayView(DisplayView):
                 # If user didn't want to delete unsaved changes
                 return False
         # Go on with the update
-        img_arr = load_img_and_exif(img_path)[0]
-        self.shape = img_arr.shape
-        self._scene.update_image(img_arr)
-        dummy_preannot = np.zeros(img_arr.shape[:2], dtype=np.bool)
+        self._cancel_img_request()
+        self._mask_colors = (initial_mask_color, initial_preannot_color)
+        fut = self.img_loader.submit(img_path)
+        if fut.done() and fut.exception() is None:
+            self._setup_scene(fut.result())
+        else:
+            self._setup_scene(None, read_img_shape(img_path))
+            self._img_request = img_path
+            preview_fut = self.img_loader.executor.submit(
+                load_img_preview, img_path)
+            self._img_futures = [fut, preview_fut]
+            self.futures.watch(
+                preview_fut, lambda arr: self._handle_preview(img_path, arr))
+            self.futures.watch(
+                fut, lambda arr: self._handle_full_image(img_path, arr),
+                lambda exc: self._handle_img_error(img_path, exc))
+        self._load_pairs(img_path, mask_path, preannot_path)
+        return True
+
+    def _setup_scene(self, img_arr, shape=None):
+        """
+        Resets the scene with the given image (see
+        ``MaskedImageScene.update_image``), empty masks, and empty undo stack.
+        """
+        self._scene.update_image(img_arr, shape)
+        self.shape = (self._scene.h, self._scene.w)
+        mask_color, preannot_color = self._mask_colors
+        dummy_preannot = np.zeros(self.shape, dtype=np.bool)
         dummy_mask = np.zeros_like(dummy_preannot)
         self.preannot_pmi = self._scene.add_mask(
-            dummy_preannot, initial_preannot_color)
+            dummy_preannot, preannot_color)
         self.annot_pmi = self._scene.add_mask(
-            dummy_mask, initial_mask_color)
+            dummy_mask, mask_color)
+        self._preannot_thresholder = None
         self.fit_in_scene()
         #
         self.main_window.undo_stack.clear()
         #
         self.saved_state_tracker = SavedStateTracker()
+
+    def _cancel_img_request(self):
+        """
+        Cancels the pending loads of the current image, if they haven't
+        started yet. Results of loads that can't be cancelled are ignored.
+        """
+        for fut in self._img_futures:
+            fut.cancel()
+        self._img_futures = []
+        self._img_request = None
+        for fut in self._pair_futures.values():
+            fut.cancel()
+        self._pair_futures = {}
+        self._pair_request = None
+        self._unapplied_pairs = {}
+
+    @property
+    def is_loading(self):
+        """
+        True if the full resolution of the current image is not shown yet.
+        """
+        return self._img_request is not None
+
+    def _handle_preview(self, img_path, preview_arr):
+        """
+        Shows the preview, if still relevant.
+        """
+        if (img_path == self._img_request and preview_arr is not None and
+                self._scene.img_pmi is None):
+            self._scene.replace_image(preview_arr)
+
+    def _handle_img_error(self, img_path, exc):
+        """
+        Stops waiting for the image, and raises the exception so that it
+        gets reported. The blank scene is removed, so there is nothing left
+        to be edited or saved.
+        """
+        if img_path == self._img_request:
+            self._cancel_img_request()
+            self._clear_scene()
+        raise exc
+
+    def _clear_scene(self):
+        """
+        Replaces the scene with an empty one, and resets the masks, undo
+        stack and saved state, as before loading any image.
+        """
+        self._scene = MaskedImageScene(tile_size=self._scene.tile_size)
+        self.setScene(self._scene)
+        self.shape = None
+        self.preannot_pmi = None
+        self.annot_pmi = None
+        self._preannot_thresholder = None
+        self.main_window.undo_stack.clear()
+        self.saved_state_tracker = None
+
+    def _handle_full_image(self, img_path, img_arr):
+        """
+        Shows the full image, if still relevant.
+        """
+        if img_path != self._img_request:
+            return
+        self._img_request = None
+        self._img_futures = []
+        if img_arr.shape[:2] == self.shape:
+            self._scene.replace_image(img_arr)
+        else:
+            # the header was misleading: start over with the actual shape.
+            # Nothing is lost, since editing is blocked while loading
+            self._setup_scene(img_arr)
+        self._handle_pairs(img_path)
+
+    def prefetch_images(self, img_paths):
+        """
+        Starts decoding the given images in the background, so that a later
+        ``new_image`` with any of them doesn't have to wait. Returns
+        immediately.
+        """
+        self.img_loader.prefetch(img_paths)
+
+    def _load_pairs(self, img_path, mask_path=None, preannot_path=None):
+        """
+        Starts loading the masks paired with the current image (see
+        ``new_image``), applying them if they were already prefetched.
+        """
+        if mask_path is not None:
+            self._pair_futures["mask"] = self.mask_loader.submit(mask_path)
+        if preannot_path is not None:
+            self._pair_futures["preannot"] = self.preannot_loader.submit(
+                preannot_path)
+        if not self._pair_futures:
+            return
+        self._pair_request = img_path
+        if all(fut.done() for fut in self._pair_futures.values()):
+            self._handle_pairs(img_path)
+        else:
+            for fut in self._pair_futures.values():
+                self.futures.watch(fut,
+                                   lambda _: self._handle_pairs(img_path),
+                                   lambda _: self._handle_pairs(img_path))
+
+    def _handle_pairs(self, img_path):
+        """
+        Applies the paired masks of the given image, if still relevant and
+        once all of them and the full image are loaded.
+
+        Failed loads are reported to ``sys.excepthook`` (e.g.
+        ``ExceptionDialog.excepthook``) instead of raised, since this may be
+        called from ``new_image``, which must complete anyway. The successful
+        ones are applied.
+
+        If the masks were edited in the meantime, they are kept untouched:
+        the pairs are not applied, but kept for ``apply_pairs``, and this is
+        reported in the status bar.
+        """
+        if (img_path != self._pair_request or self.is_loading or not all(
+                fut.done() for fut in self._pair_futures.values())):
+            return
+        futs = self._pair_futures
+        self._pair_request = None
+        self._pair_futures = {}
+        if self.saved_state_tracker.num_edits > 0:
+            self._unapplied_pairs = futs
+            self.main_window.statusBar().showMessage(
+                "The paired mask and preannotation were not applied, since "
+                "the masks were edited while loading. Use Edit > {} to "
+                "apply them.".format(self.main_window.APPLY_PAIRS_TXT))
+            return
+        self._apply_pairs(futs)
+
+    def apply_pairs(self):
+        """
+        Applies the paired masks that were loaded for the current image but
+        not applied (see ``_handle_pairs``), replacing the edited ones. This
+        counts as an edit.
+
+        :returns: True if there was anything to apply, False otherwise.
+        """
+        futs = self._unapplied_pairs
+        if not futs:
+            return False
+        self._unapplied_pairs = {}
+        self._apply_pairs(futs)
+        self.saved_state_tracker.edit()
+        self.main_window.statusBar().clearMessage()
         return True
 
-    def preannot_from_path(self, preannot_path, rgba, upper_thresh=100,
-                           lower_thresh=90, normalize=False):
+    def _apply_pairs(self, futs):
+        """
+        Applies the given (done) mask and preannot futures, see
+        ``_handle_pairs``.
+        """
+        errors = [fut.exception() for fut in futs.values()
+                  if fut.exception() is not None]
+        if "mask" in futs and futs["mask"].exception() is None:
+            mask = futs["mask"].result()
+            if mask.shape != self.shape:
+                errors.append(ValueError(
+                    "Mask shape {} doesn't match image shape {}!".format(
+                        mask.shape, self.shape)))
+            else:
+                self.annot_pmi = self._scene.replace_mask_pmi(
+                    self.annot_pmi, mask)
+        if "preannot" in futs and futs["preannot"].exception() is None:
+            thresholder, codes = futs["preannot"].result()
+            if codes.shape != self.shape:
+                errors.append(ValueError(
+                    "Preannotation shape {} doesn't match image shape {}!"
+                    .format(codes.shape, self.shape)))
+            else:
+                # same thresholds as the sliders, like a manual load
+                self._set_preannot(thresholder, codes,
+                                   *self.main_window.preannot_thresholds())
+        for exc in errors:
+            sys.excepthook(type(exc), exc, exc.__traceback__)
+
+    def prefetch_pairs(self, mask_paths=(), preannot_paths=()):
         """
-        This method is prototype-ish: It loads an ``.npz`` file with and
-        'entropy' field, expected to have a numpy float matrix with same
-        shape as the image. Alternatively it takes a greyscale image file 
-        suppoted by PIL.
+        Like ``prefetch_images``, for the masks and preannotations to be
+        passed to ``new_image``.
         """
-        assert self.scene().img_pmi is not None, \
+        self.mask_loader.prefetch(mask_paths)
+        self.preannot_loader.prefetch(preannot_paths)
+
+    def preannot_from_path(self, preannot_path, rgba, upper_thresh=100,
+                           lower_thresh=90, npz_field=None):
+        """
+        This method is prototype-ish: It loads an ``.npz`` file with a
+        ``npz_field`` field (by default ``MainWindow.PREANNOT_NPZ_FIELD``),
+        expected to have a numpy float matrix with same shape as the image.
+        Alternatively it takes an ``.npy`` file with the matrix, or a
+        greyscale image file suppoted by PIL. Matrices of reduced precision
+        like ``np.float16`` or ``np.uint8`` are supported, and save memory.
+
+        ``.npy`` files, and ``.npz`` files saved without compression, are
+        memory-mapped instead of loaded, which is much faster.
+
+        Only the ``np.uint8`` quantization of the map is kept in memory.
+        Since thresholds are percentiles, the map doesn't need to be
+        normalized.
+        """
+        assert self.shape is not None, \
             "You need to load an image first!"
-        if preannot_path.endswith(".npz") or preannot_path.endswith(".npy"):
-            self._preannot_pmap = np.load(preannot_path)["entropy"]
-        else:
-            img=np.asanyarray(Image.open(preannot_path))
-            if len(img.shape)>2:
-                img=img[:,:,0]
-            self._preannot_pmap = np.asarray(img)
-            normalize=True
-
-        if normalize:
-            try:
-                self._preannot_pmap = self._preannot_pmap/np.max(self._preannot_pmap)
-            except ZeroDivisionError:
-                pass
-        m = pmap_to_mask(self._preannot_pmap, upper_thresh, lower_thresh)
-        self.preannot_pmi = self.scene().replace_mask_pmi(
-            self.preannot_pmi, m)
+        assert not self.is_loading, "Wait until the image is loaded!"
+        if npz_field is None:
+            npz_field = self.main_window.PREANNOT_NPZ_FIELD
+        thresholder, codes = load_preannot(
+            preannot_path, self.main_window.THRESH_NUM_STEPS, npz_field)
+        self._set_preannot(thresholder, codes, upper_thresh, lower_thresh)
         #
         self.saved_state_tracker.edit()
 
+    def _set_preannot(self, thresholder, codes, upper_thresh=100,
+                      lower_thresh=90):
+        """
+        Replaces the preannotation with the output of ``load_preannot``.
+        """
+        self._preannot_thresholder = thresholder
+        lut = thresholder.code_lut(upper_thresh, lower_thresh,
+                                   IndexedMaskItem.NUM_RESERVED_CODES)
+        self.preannot_pmi = self.scene().replace_mask_pmi(
+            self.preannot_pmi, codes, code_lut=lut)
+
     def mask_from_path(self, mask_path, rgba):
         """
         :param mask_path: Path to an image containing a binary mask, where
-          zero pixels are considered false and non-zero true.
+          zero pixels are considered false and non-zero true, or to a mask
+          in any of the formats of ``IntegratedSaveForm``.
         :param rgba: Color of the loaded mask
 
         Loads a binary mask into the scene as an RGBA-colored mask.
         """
 
-        assert self.scene().img_pmi is not None, \
+        assert self.shape is not None, \
             "You need to load an image first!"
-        arr = load_img_and_exif(mask_path)[0]
-        if len(arr.shape) == 2:
-            mask = arr > 0
-        elif len(arr.shape) == 3:
-            mask = arr.any(axis=-1)
-        else:
-            raise RuntimeError("Mask must be rank 2 or 3!")
+        assert not self.is_loading, "Wait until the image is loaded!"
+        mask = load_bool_arr(mask_path)
         self.annot_pmi = self.scene().replace_mask_pmi(
             self.annot_pmi, mask)
         #
         self.saved_state_tracker.edit()
 
     # MASK SINGLE-SHOT ACTIONS
+    def preview_preannot_pval(self, upper_thresh, lower_thresh):
+        """
+        Like ``change_preannot_pval``, but doesn't count as an edit. Since
+        thresholds only change the color table of the preannot mask, this is
+        fast enough to be called while dragging the sliders.
+        """
+        if self._preannot_thresholder is not None:
+            lut = self._preannot_thresholder.code_lut(
+                upper_thresh, lower_thresh, IndexedMaskItem.NUM_RESERVED_CODES)
+            self.scene().change_mask_color(self.preannot_pmi, code_lut=lut)
+
     def change_preannot_pval(self, upper_thresh, lower_thresh):
         """
         Updates the preannot->mask threshold.
         """
-        if self._preannot_pmap is not None:
-            new_m = pmap_to_mask(self._preannot_pmap, 
-                                upper_thresh,
-                                lower_thresh)
-            self.preannot_pmi = self.scene().replace_mask_pmi(
-                self.preannot_pmi, new_m)
-        #
-        if self.saved_state_tracker is not None:
+        self.preview_preannot_pval(upper_thresh, lower_thresh)
+        # without preannotation (e.g. still loading), nothing changed
+        if (self.saved_state_tracker is not None and
+                self._preannot_thresholder is not None):
             self.saved_state_tracker.edit()
 
     def change_preannot_rgba(self, rgba):
         """
-        Updates the preannot mask color.
+        Updates the preannot mask color. Only its color table changes, so
+        this doesn't depend on the image size.
         """
         if self.preannot_pmi is not None:
-            m = self.scene().mask_as_bool_arr(self.preannot_pmi)
-            self.preannot_pmi = self.scene().replace_mask_pmi(
-                self.preannot_pmi, m, rgba)
+            self.scene().change_mask_color(self.preannot_pmi, rgba)
 
     def change_annot_rgba(self, rgba):
         """
-        Updates the annot mask color.
-
+        Updates the annot mask color. Like ``change_preannot_rgba``, the mask
+        item is kept, so the undo history of its strokes stays valid.
         """
         if self.annot_pmi is not None:
-            m = self.scene().mask_as_bool_arr(self.annot_pmi)
-            self.annot_pmi = self.scene().replace_mask_pmi(
-                self.annot_pmi, m, rgba)
+            self.scene().change_mask_color(self.annot_pmi, rgba)
 
     # MASK COMPOSITE ACTIONS
     def _finish_clickdrag_action(self):
@@ -326,9 +863,8 @@ class IntegratedDisplayView(DisplayView):
           x, y = current_action_position...
           pmi = ...
           brush_size = ...
-          rgba = self.scene().mask_pmis[pmi]
           self._perform_composite_action(DrawCommand, [x, y],
-                                         [pmi, rgba, brush_size])
+                                         [pmi, brush_size, spacing])
         """
         cmd = self._current_clickdrag_action
         # if changed to this action without releasing the prior one, release it
@@ -355,6 +891,8 @@ class IntegratedDisplayView(DisplayView):
         """
         # retrieve pmi info
         # expected idx: 0 for preannot, 1 for annot
+        if self.is_loading:
+            return  # the masks may still be reset, see _handle_full_image
         idx_map = {0: self.preannot_pmi, 1: self.annot_pmi}
         mask_idx = self.main_window.paint_form.current_button_idx
         pmi = idx_map[mask_idx]
@@ -367,22 +905,22 @@ class IntegratedDisplayView(DisplayView):
                                 self.main_window.MASKED_PAINTER_TXT]
         brush_type = self.main_window.paint_form.current_brush_type
         brush_size = self.main_window.paint_form.current_brush_size
+        spacing = self.main_window.BRUSH_SPACING
         # if no open action exists, create:
         did_something = False
         if brush_type == p_txt:
-            rgba = self.scene().mask_pmis[pmi]
             self._perform_composite_action(DrawCommand, [x, y],
-                                           [pmi, rgba, brush_size])
+                                           [pmi, brush_size, spacing])
             did_something = True
         elif brush_type == e_txt:
             self._perform_composite_action(EraseCommand, [x, y],
-                                           [pmi, brush_size])
+                                           [pmi, brush_size, spacing])
             did_something = True
         elif brush_type == mp_txt:
-            rgba = self.scene().mask_pmis[pmi]
             ref_pmi = self.preannot_pmi  # preannot is always the ref
             self._perform_composite_action(DrawOverlappingCommand, [x, y],
-                                           [pmi, ref_pmi, rgba, brush_size])
+                                           [pmi, ref_pmi, brush_size,
+                                            spacing])
             did_something = True
         #
         if did_something:
@@ -391,7 +929,7 @@ class IntegratedDisplayView(DisplayView):
     def add_point(self, x, y, close_after=False):
         """
         """
-        if self.scene().img_pmi is None:
+        if self.shape is None or self.is_loading:
             return
         brush_size = self.main_window.paint_form.current_brush_size
         self.scene().object_action(
@@ -468,6 +1006,13 @@ class CrackAnnotPaintForm(MaskPaintForm):
         """
         self.main_window.graphics_view.change_preannot_pval(t,t2)
 
+    def threshold_slider_moved(self, t, t2):
+        """
+            :param t : Upper Threshold
+            :param t2 : Lower Threshold
+        """
+        self.main_window.graphics_view.preview_preannot_pval(t, t2)
+
     def rgba_box_changed(self, idx, r, g, b, a):
         """
         Update corresponding mask with new RGBA color.
@@ -508,7 +1053,8 @@ class MainWindow(QtWidgets.QMainWindow):
     of all the used elements, together with the logic that binds them.
     """
 
-    # These variables handle the preannotation thresholding. Check pmap_to_mask
+    # These variables handle the preannotation thresholding. Check
+    # PercentileThresholder
     DISCARD_P_VALUE = 0.5  # Number in range (thresh_slider_max, 1]
     THRESH_MIN = 0
     THRESH_MAX = 100
@@ -518,6 +1064,18 @@ class MainWindow(QtWidgets.QMainWindow):
     ERASER_TXT = "Eraser"
     MASKED_PAINTER_TXT = "Masked painter"
     POINT_LIST_TXT = "Points"
+    PREFETCH_RADIUS = 1  # neighbours of the current image to be decoded
+    AUTO_LOAD_PAIRS = False  # initial state of the auto-load menu action
+    APPLY_PAIRS_TXT = "Apply paired mask and preannotation"
+    BRUSH_SPACING = 0.25  # between circles of a stroke, relative to size
+    #
+    UNDO_MEMORY_BUDGET = 1024 ** 3  # in bytes, oldest strokes are evicted
+    PREANNOT_NPZ_FIELD = "entropy"  # name of the pmap in .npz preannots
+    # formats that can be auto-loaded, see _paired_paths
+    MASK_EXTENSIONS = (".png", ".bmp", ".tif", ".tiff", ".jpg", ".jpeg",
+                       ".npz", ".json")
+    PREANNOT_EXTENSIONS = (".npy", ".npz", ".png", ".bmp", ".tif", ".tiff",
+                           ".jpg", ".jpeg")
 
     def __init__(self, parent=None, initial_mask_color=(255, 54, 76, 150),
                  initial_preannot_color=(102, 214, 123, 100),
@@ -545,8 +1103,9 @@ class MainWindow(QtWidgets.QMainWindow):
             thresh_max=self.THRESH_MAX, thresh_num_steps=self.THRESH_NUM_STEPS)
         self.save_form = IntegratedSaveForm(self, default_path=None)
 
-        self.paint_form.add_item("preannot.", self.preannot_color,
-                                 slider_visible=True, activate=False)
+        self.preannot_item_idx = self.paint_form.add_item(
+            "preannot.", self.preannot_color, slider_visible=True,
+            activate=False)
         self.paint_form.add_item("annot.", self.mask_color,
                                  slider_visible=False, activate=True)
         # create controller layout
@@ -571,22 +1130,37 @@ class MainWindow(QtWidgets.QMainWindow):
         self.main_splitter.setSizes([left_width, right_width * 2])
         self.setCentralWidget(self.main_splitter)
         # add connections
-        self.file_lists.img_list.file_list.itemDoubleClicked.connect(
-            lambda elt: self._handle_img_selection(elt.text()))
-        self.file_lists.mask_list.file_list.itemDoubleClicked.connect(
-            lambda elt: self._handle_mask_selection(elt.text()))
-        self.file_lists.preannot_list.file_list.itemDoubleClicked.connect(
-            lambda elt: self._handle_preannot_selection(elt.text()))
+        self.file_lists.img_list.itemDoubleClicked.connect(
+            self._handle_img_selection)
+        self.file_lists.mask_list.itemDoubleClicked.connect(
+            self._handle_mask_selection)
+        self.file_lists.preannot_list.itemDoubleClicked.connect(
+            self._handle_preannot_selection)
+        # the side lists also pair the files named like the saved ones
+        self.save_form.suffixesChanged.connect(self._update_pair_suffixes)
+        self._update_pair_suffixes()
         #
         self._setup_undo()
         self._setup_menu_bar()
         self._add_keymaps()
 
+    def _update_pair_suffixes(self):
+        """
+        Makes the mask and preannotation lists pair images with the files
+        named after the current suffixes of ``save_form``, see
+        ``FileList.set_selected_image``.
+        """
+        suffixes = self.save_form.suffixes()
+        for flist in (self.file_lists.mask_list,
+                      self.file_lists.preannot_list):
+            if flist is not None:
+                flist.set_pair_suffixes(suffixes)
+
     def _setup_undo(self):
         """
         Set up undo stack and undo view
         """
-        self.undo_stack = QtWidgets.QUndoStack(self)
+        self.undo_stack = MemoryBudgetUndoStack(self.UNDO_MEMORY_BUDGET, self)
         self.undo_view = QtWidgets.QUndoView(self.undo_stack)
         self.undo_view.setWindowTitle("Undo View")
         self.undo_view.setAttribute(QtCore.Qt.WA_QuitOnClose, False)
@@ -604,6 +1178,14 @@ class MainWindow(QtWidgets.QMainWindow):
         edit_menu.addSeparator()
         self.view_undo_action = edit_menu.addAction("View undo stack")
         self.view_undo_action.triggered.connect(self.undo_view.show)
+        edit_menu.addSeparator()
+        self.auto_load_action = edit_menu.addAction(
+            "Auto-load paired mask and preannotation")
+        self.auto_load_action.setCheckable(True)
+        self.auto_load_action.setChecked(self.AUTO_LOAD_PAIRS)
+        self.apply_pairs_action = edit_menu.addAction(self.APPLY_PAIRS_TXT)
+        self.apply_pairs_action.triggered.connect(
+            self.graphics_view.apply_pairs)
         # help menu
         help_menu = self.menuBar().addMenu("Help")
         self.keyboard_shortcuts = help_menu.addAction("Keyboard shortcuts")
@@ -687,12 +1269,13 @@ class MainWindow(QtWidgets.QMainWindow):
         this method, which will switch to the image located at
         ``curent_img + step`` in the list.
         """
-        curr_idx = self.file_lists.img_list.file_list.currentRow()
-        nxt_item = self.file_lists.img_list.file_list.item(curr_idx + step)
-        if nxt_item is not None:
-            success = self._handle_img_selection(nxt_item.text())
+        img_list = self.file_lists.img_list
+        nxt_row = img_list.current_row() + step
+        nxt_name = img_list.model.name(nxt_row)
+        if nxt_name is not None:
+            success = self._handle_img_selection(nxt_name)
             if success:
-                self.file_lists.img_list.file_list.setCurrentItem(nxt_item)
+                img_list.set_current_row(nxt_row)
 
     def _handle_img_selection(self, basename):
         """
@@ -700,24 +1283,94 @@ class MainWindow(QtWidgets.QMainWindow):
         image list item, or called by ``_switch_img``.
         """
         abspath = os.path.join(self.file_lists.img_list.dirpath, basename)
-        success = self.graphics_view.new_image(abspath, self.mask_color,
-                                               self.preannot_color)
+        mask_path, preannot_path = None, None
+        if self.auto_load_action.isChecked():
+            mask_path, preannot_path = self._paired_paths(basename)
+        success = self.graphics_view.new_image(
+            abspath, self.mask_color, self.preannot_color,
+            mask_path, preannot_path)
 
+        # show only the files paired with the image. No disk access needed
         if self.file_lists.preannot_list is not None:
-            self.file_lists.preannot_list.update_path(self.file_lists.preannot_list.dirpath,
-                                                           basename)
+            self.file_lists.preannot_list.set_selected_image(basename)
         if self.file_lists.mask_list is not None:
-            self.file_lists.mask_list.update_path(self.file_lists.mask_list.dirpath,
-                                                           basename)
+            self.file_lists.mask_list.set_selected_image(basename)
         if success:
             self.current_img_basename = basename
+            self._prefetch_neighbours(basename)
         return success
 
+    def _prefetch_neighbours(self, basename):
+        """
+        Starts decoding the images around ``basename`` in the image list, so
+        that switching to them is fast.
+        """
+        img_list = self.file_lists.img_list
+        row = img_list.model.row(basename)
+        if row < 0:
+            return
+        paths, mask_paths, preannot_paths = [], [], []
+        auto_load = self.auto_load_action.isChecked()
+        for delta in range(1, self.PREFETCH_RADIUS + 1):
+            for nxt_row in (row + delta, row - delta):
+                name = img_list.model.name(nxt_row)
+                if name is None:
+                    continue
+                paths.append(os.path.join(img_list.dirpath, name))
+                if auto_load:
+                    mask_path, preannot_path = self._paired_paths(name)
+                    if mask_path is not None:
+                        mask_paths.append(mask_path)
+                    if preannot_path is not None:
+                        preannot_paths.append(preannot_path)
+        self.graphics_view.prefetch_images(paths)
+        self.graphics_view.prefetch_pairs(mask_paths, preannot_paths)
+
+    def _paired_paths(self, basename):
+        """
+        :returns: A tuple ``(mask_path, preannot_path)`` with the files from
+          the mask and preannotation lists paired with the given image name
+          (see ``pick_paired_file``), or ``None`` if not found.
+
+        Only exact pairings are returned, since auto-loaded files are shown
+        (and saved) as the image's own. Masks must be named like the ones
+        saved by ``save_form``, i.e. ``<basename or stem><annot suffix>``,
+        in any of the ``MASK_EXTENSIONS`` and possibly numbered by
+        ``UniqueFilenameAllocator``. Preannotations must be named
+        ``<basename or stem><ext>``, for any of the ``PREANNOT_EXTENSIONS``.
+        """
+        stem = os.path.splitext(basename)[0]
+        annot_suffix = self.save_form.suffixes()[1]
+        annot_stem = os.path.splitext(annot_suffix)[0]
+        # masks: exact save names first, then other formats and numberings
+        mask_list = self.file_lists.mask_list
+        annot_re = re.compile(r"(?:{}|{}){}(?:_\(\d+\))?\.[^.]+".format(
+            re.escape(basename), re.escape(stem), re.escape(annot_stem)),
+            re.IGNORECASE)
+        candidates = {c for c in mask_list.paired_names(basename)
+                      if c.lower().endswith(self.MASK_EXTENSIONS) and
+                      annot_re.fullmatch(c)}
+        mask_name = pick_paired_file(
+            candidates, [basename + annot_suffix, stem + annot_suffix] +
+            sorted(candidates))
+        # preannotations: in order of PREANNOT_EXTENSIONS
+        preannot_list = self.file_lists.preannot_list
+        preannot_name = pick_paired_file(
+            preannot_list.paired_names(basename) - {basename},
+            [name + ext for ext in self.PREANNOT_EXTENSIONS
+             for name in (stem, basename)])
+        #
+        return tuple(None if name is None else os.path.join(fl.dirpath, name)
+                     for fl, name in ((mask_list, mask_name),
+                                      (preannot_list, preannot_name)))
+
     def _handle_mask_selection(self, basename):
         """
         This protected method is triggered when double clicking on an
         annotation list item.
         """
+        if self._is_img_loading():
+            return
         abspath = os.path.join(self.file_lists.mask_list.dirpath, basename)
         self.graphics_view.mask_from_path(abspath, self.mask_color)
 
@@ -726,11 +1379,29 @@ class MainWindow(QtWidgets.QMainWindow):
         This protected method is triggered when double clicking on a
         preannotation list item.
         """
+        if self._is_img_loading():
+            return
         abspath = os.path.join(self.file_lists.preannot_list.dirpath, basename)
-        pval = self.paint_form.slider_to_p_val(
-            self.paint_form._sliders[-1].value())
         self.graphics_view.preannot_from_path(
-            abspath, self.preannot_color)
+            abspath, self.preannot_color, *self.preannot_thresholds())
+
+    def _is_img_loading(self):
+        """
+        :returns: ``graphics_view.is_loading``. If true, this is also shown
+          in the status bar.
+        """
+        if self.graphics_view.is_loading:
+            self.statusBar().showMessage(
+                "The image is still loading, try again in a moment.", 3000)
+            return True
+        return False
+
+    def preannot_thresholds(self):
+        """
+        :returns: The ``(upper, lower)`` preannotation thresholds currently
+          set in the sliders, as passed to ``change_preannot_pval``.
+        """
+        return self.paint_form.thresholds(self.preannot_item_idx)
 
     def wheelEvent(self, event):
         """
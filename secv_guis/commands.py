@@ -8,13 +8,76 @@ to undo and redo them.
 Composite commands deserve a special mention: they are trains of actions
 that only track, store and report the initial and final state. They are
 particularly useful when performing interactive editings on big datastructures
-like pixmaps, to prevent memory bloating.
+like masks, to prevent memory bloating.
 """
 
 
+import math
+import zlib
+import functools
+#
 import numpy as np
 from PySide2 import QtCore, QtWidgets, QtGui
-from .utils import pixmap_to_arr
+
+
+# #############################################################################
+# ## HELPERS
+# #############################################################################
+class ArrayPatch:
+    """
+    Stores a rectangular region of a 2D array, so that it can be pasted back
+    later. Optionally, the contents are compressed with ``zlib``, which is
+    very effective for masks.
+    """
+    def __init__(self, arr, x0, y0, compression_level=1):
+        """
+        :param arr: The 2D region to be stored. It will be copied.
+        :param x0: Horizontal position of the region in the full array.
+        :param y0: Vertical position of the region in the full array.
+        :param compression_level: For ``zlib``. If 0, no compression.
+        """
+        self.x0, self.y0 = x0, y0
+        self.shape = arr.shape
+        self.dtype = arr.dtype
+        self.compressed = compression_level > 0
+        if self.compressed:
+            self.data = zlib.compress(np.ascontiguousarray(arr).data,
+                                      compression_level)
+        else:
+            self.data = arr.copy()
+
+    @property
+    def x1(self):
+        """
+        """
+        return self.x0 + self.shape[1]
+
+    @property
+    def y1(self):
+        """
+        """
+        return self.y0 + self.shape[0]
+
+    def nbytes(self):
+        """
+        :returns: The number of bytes taken by the stored contents.
+        """
+        return len(self.data) if self.compressed else self.data.nbytes
+
+    def paste(self, dst_arr):
+        """
+        Writes the stored contents into ``dst_arr``, at the stored position.
+        """
+        if self.compressed:
+            arr = np.frombuffer(zlib.decompress(self.data),
+                                dtype=self.dtype).reshape(self.shape)
+        else:
+            arr = self.data
+        dst_arr[self.y0:self.y1, self.x0:self.x1] = arr
+
+# #############################################################################
+# ## HELPERS
+# #############################################################################
 
 
 # #############################################################################
@@ -105,139 +168,365 @@ class CompositeCommand(QtWidgets.QUndoCommand):
 
 class DrawCommand(CompositeCommand):
     """
-    A composite command to draw a stroke of circles into a ``PixmapIten``.
+    A composite command to draw a stroke of circles into an
+    ``IndexedMaskItem``. The circles are rasterized by a painter that stays
+    open for the whole stroke, on a layer of the size of the item. Then, the
+    region around them is written into the codes of the item, and only that
+    region is refreshed (throttled, see ``IndexedMaskItem.schedule_update``).
+    This way, the cost of each action depends on the brush size, not on the
+    image size. Consecutive positions are joined by evenly spaced circles,
+    so the stroke has no gaps.
+
+    For undo, the original contents are saved tile by tile, the first time a
+    tile is painted. Once finished, the command only keeps the before and
+    after patches of the bounding box of the touched tiles, compressed.
     """
     COMMAND_NAME = "Draw"
+    TILE_SIZE = 64
+    COMPRESSION_LEVEL = 1  # zlib level of the undo patches. 0 to disable
+    MAX_PATCH_LENGTH = 512  # in pixels, longer segments are split
 
-    def __init__(self, pmi, rgba, diameter,
-                 comp_mode=QtGui.QPainter.CompositionMode_Source, parent=None):
+    def __init__(self, pmi, diameter, spacing=0.25, parent=None):
         """
-        :param pmi: A ``PixmapItem``, where this command will apply.
-        :param rgba: A tuple ``(r, g, b, a)`` of ``0-255`` values.
+        :param pmi: An ``IndexedMaskItem``, where this command will apply.
         :param diameter: In pixels, diameter of the circle to be drawn.
-        :param comp_mode: The "Source" mode ensures that the alphas don't
-          get added.
+        :param spacing: Maximal distance between consecutive circles of the
+          stroke, as a fraction of the diameter (but at least 1 pixel).
+          Moves shorter than this are accumulated.
         """
         super().__init__(parent)
-        # Caution: memory intensive? (<100 commands on 4k*6k seems ok)
-        self.original_pixmap = pmi.pixmap()
-        self.final_pixmap = pmi.pixmap()
-        #
         self.pmi = pmi
-        self.rgba = rgba
         self.diameter = diameter
-        self.comp_mode = comp_mode
+        self.spacing = max(1.0, diameter * spacing)
+        self._last_dab = None  # center of the last painted circle
+        self._pending = None  # last position, if not painted yet
+        self.code = pmi.ON
+        # original contents of the touched tiles, indexed by (row, col)
+        self._saved_tiles = {}
+        self.changed = False
+        self.before = None
+        self.after = None
         #
-        color = QtGui.QColor(*rgba)
-        self.brush = QtGui.QBrush(color, bs=QtCore.Qt.SolidPattern)
-        self.pen = QtGui.QPen(color)
+        self.brush = QtGui.QBrush(QtCore.Qt.white, bs=QtCore.Qt.SolidPattern)
+        self.pen = QtGui.QPen(QtCore.Qt.white)
+        # stroke layer and its painter, alive from first action to finish
+        self._layer = None
+        self._layer_img = None
+        self._painter = None
+
+    def _dab_rect(self, x_pos, y_pos):
+        """
+        :returns: The ``QRect`` with the circle to be drawn at the given
+          position.
+        """
+        radius = self.diameter // 2
+        return QtCore.QRect(int(x_pos) - radius, int(y_pos) - radius,
+                            self.diameter, self.diameter)
+
+    def _mask_patch(self, rect, painted):
+        """
+        Override me!
+        :param rect: The ``QRect`` of the patch being painted.
+        :param painted: A ``np.bool(h, w)`` array of the size of ``rect``,
+          true where the stroke was painted.
+        :returns: A boolean array like ``painted``, true where the stroke
+          should be written into the item.
+        """
+        return painted
+
+    def _dab_positions(self, x_pos, y_pos):
+        """
+        :returns: A list with the ``(x, y)`` centers of the dabs needed to
+          reach the given position from the last dab, spaced by at most
+          ``self.spacing``. If the position is closer than that, the list is
+          empty and the position is left pending.
+        """
+        if self._last_dab is None:
+            return [(x_pos, y_pos)]
+        last_x, last_y = self._last_dab
+        dx, dy = x_pos - last_x, y_pos - last_y
+        dist = math.hypot(dx, dy)
+        if dist < self.spacing:
+            self._pending = (x_pos, y_pos)
+            return []
+        num_dabs = math.ceil(dist / self.spacing)
+        return [(last_x + dx * i / num_dabs, last_y + dy * i / num_dabs)
+                for i in range(1, num_dabs + 1)]
+
+    def _begin_stroke(self):
+        """
+        Creates the stroke layer: a ``Grayscale8`` image of the size of the
+        item, sharing memory with ``self._layer``, and opens the painter that
+        will draw on it until ``finish``. The layer is zero-initialized
+        lazily by the OS, so only the touched parts take memory.
+        """
+        h, w = self.pmi.h, self.pmi.w
+        self._layer = np.zeros((h, (w + 3) & ~3), dtype=np.uint8)
+        self._layer_img = QtGui.QImage(self._layer.data, w, h,
+                                       self._layer.strides[0],
+                                       QtGui.QImage.Format_Grayscale8)
+        self._painter = QtGui.QPainter(self._layer_img)
+        self._painter.setBrush(self.brush)
+        self._painter.setPen(self.pen)
+
+    def _end_stroke(self):
+        """
+        Closes the painter and releases the stroke layer.
+        """
+        if self._painter is not None:
+            self._painter.end()
+        self._painter = None
+        self._layer_img = None
+        self._layer = None
+
+    def _paint_patch(self, rect, xywhs):
+        """
+        :param rect: The region of the item to be painted, as a ``QRect``.
+        :param xywhs: A list of ``QRect`` with the circles to be drawn,
+          possibly exceeding ``rect`` if at the border of the item.
+        :returns: A ``np.bool(h, w)`` array of the size of ``rect``, true
+          where the stroke has to be written (see ``_mask_patch``).
+        """
+        if self._painter is None:
+            self._begin_stroke()
+        for xywh in xywhs:
+            self._painter.drawEllipse(xywh)
+        x0, y0 = rect.x(), rect.y()
+        painted = self._layer[y0:y0 + rect.height(),
+                              x0:x0 + rect.width()].astype(np.bool)
+        return self._mask_patch(rect, painted)
+
+    def _paint_dabs(self, positions):
+        """
+        Paints circles at the given ``(x, y)`` positions into the item. The
+        positions are expected to follow a path, and are painted in batches
+        that span at most ``MAX_PATCH_LENGTH`` pixels, one painter each.
+        """
+        if not positions:
+            return
+        self._last_dab = positions[-1]
+        self._pending = None
+        bounds = QtCore.QRect(0, 0, self.pmi.w, self.pmi.h)
+        chunk = max(1, int(self.MAX_PATCH_LENGTH / self.spacing))
+        for i in range(0, len(positions), chunk):
+            xywhs = [self._dab_rect(x, y) for x, y in positions[i:i + chunk]]
+            rect = functools.reduce(QtCore.QRect.united, xywhs)
+            # the outline pen extends the circles by 1 pixel
+            rect = rect.adjusted(0, 0, 1, 1).intersected(bounds)
+            if rect.isEmpty():
+                continue
+            self._write_patch(rect, self._paint_patch(rect, xywhs))
+
+    def _write_patch(self, rect, dab):
+        """
+        Writes ``self.code`` into the item wherever ``dab`` is true.
+        :param rect: The ``QRect`` of the item to be written.
+        :param dab: A ``np.bool(h, w)`` array of the size of ``rect``.
+        """
+        x0, y0 = rect.x(), rect.y()
+        x1, y1 = x0 + rect.width(), y0 + rect.height()
+        region = self.pmi.arr[y0:y1, x0:x1]
+        # skip dabs that don't change anything. Since a command writes a
+        # single code, any change makes the final state differ from the
+        # original, so this also tells whether the command is worth storing
+        if not (region[dab] != self.code).any():
+            return
+        self.changed = True
+        self._save_tiles(x0, y0, x1, y1)
+        region[dab] = self.code
+        self.pmi.schedule_update(x0, y0, x1, y1)
 
     def action(self, x_pos, y_pos):
         """
         Once the object has been constructed **and ``finish()`` hasn't been
         called yet**, Call this function to paint a circle at given position.
-        Check constructor for further variables.
+        The stroke is interpolated from the prior position, so that fast
+        moves don't leave gaps. Check constructor for further variables.
         """
         super().action()
-        # get painter and set it up
-        painter = QtGui.QPainter(self.final_pixmap)
-        painter.setCompositionMode(self.comp_mode)
-        painter.setBrush(self.brush)
-        painter.setPen(self.pen)
-        #
-        diameter = self.diameter
-        radius = diameter // 2
-        xywh = (x_pos - radius, y_pos - radius, diameter, diameter)
-        painter.drawEllipse(QtCore.QRect(*xywh))
-        painter.end()
-        self.pmi.setPixmap(self.final_pixmap)
+        self._paint_dabs(self._dab_positions(x_pos, y_pos))
+
+    def _save_tiles(self, x0, y0, x1, y1):
+        """
+        Saves the original contents of the tiles overlapping the given
+        region, unless they were already saved.
+        """
+        ts = self.TILE_SIZE
+        for row in range(y0 // ts, (y1 - 1) // ts + 1):
+            for col in range(x0 // ts, (x1 - 1) // ts + 1):
+                if (row, col) not in self._saved_tiles:
+                    self._saved_tiles[(row, col)] = self.pmi.arr[
+                        row * ts:(row + 1) * ts, col * ts:(col + 1) * ts
+                    ].copy()
+
+    def _paste(self, patch):
+        """
+        """
+        if patch is None:  # evicted
+            return
+        patch.paste(self.pmi.arr)
+        self.pmi.update_region(patch.x0, patch.y0, patch.x1, patch.y1)
 
     def redo(self):
         """
         This function implements the interface for the UndoStack. Don't call
         this directly.
         """
-        self.pmi.setPixmap(self.final_pixmap)
+        self._paste(self.after)
 
     def undo(self):
         """
         This function implements the interface for the UndoStack. Don't call
         this directly.
         """
-        self.pmi.setPixmap(self.original_pixmap)
+        self._paste(self.before)
+
+    def nbytes(self):
+        """
+        :returns: The number of bytes taken by the undo patches.
+        """
+        return sum(p.nbytes() for p in (self.before, self.after)
+                   if p is not None)
+
+    def evict(self):
+        """
+        Frees the undo patches, turning this command into a no-op that is
+        removed from the undo stack the next time it is reached.
+        """
+        self.before = None
+        self.after = None
+        self.setObsolete(True)
 
     def finish(self, undo_stack=None):
         """
-        Usually we don't override ``finish``, but since pixmaps are so big,
-        we don't want to store the command if original and final are equal.
+        Usually we don't override ``finish``, but since masks are so big,
+        we only store the touched region, and we don't want to store the
+        command if no action changed anything (see ``changed``).
         """
+        if self._pending is not None:
+            self._paint_dabs([self._pending])
+        self._end_stroke()
+        self.pmi.flush_updates()
         self.finished = True
-        if undo_stack is not None:
-            original_arr = pixmap_to_arr(self.original_pixmap,
-                                         QtGui.QImage.Format_RGBA8888)
-            final_arr = pixmap_to_arr(self.final_pixmap,
-                                      QtGui.QImage.Format_RGBA8888)
-            # Add to stack only if there is any difference
-            if not np.array_equal(original_arr, final_arr):
-                undo_stack.push(self)
+        tiles, self._saved_tiles = self._saved_tiles, {}
+        if undo_stack is None or not self.changed:
+            return
+        ts = self.TILE_SIZE
+        rows, cols = zip(*tiles)
+        y0, x0 = min(rows) * ts, min(cols) * ts
+        y1 = min((max(rows) + 1) * ts, self.pmi.h)
+        x1 = min((max(cols) + 1) * ts, self.pmi.w)
+        after = self.pmi.arr[y0:y1, x0:x1]
+        before = after.copy()
+        for (row, col), tile in tiles.items():
+            ty, tx = row * ts - y0, col * ts - x0
+            before[ty:ty + tile.shape[0], tx:tx + tile.shape[1]] = tile
+        self.before = ArrayPatch(before, x0, y0, self.COMPRESSION_LEVEL)
+        self.after = ArrayPatch(after, x0, y0, self.COMPRESSION_LEVEL)
+        undo_stack.push(self)
 
 
 class EraseCommand(DrawCommand):
     """
-    A composite command to erase a stroke of circles into a ``PixmapIten``.
-    See ``DrawCommand`` docstrings for more info.
+    A composite command to erase a stroke of circles into an
+    ``IndexedMaskItem``. See ``DrawCommand`` docstrings for more info.
     """
     COMMAND_NAME = "Erase"
 
-    def __init__(self, pmi, diameter,
-                 comp_mode=QtGui.QPainter.CompositionMode_Source, parent=None):
+    def __init__(self, pmi, diameter, spacing=0.25, parent=None):
         """
         See ``DrawCommand`` docstrings for more info.
         """
-        super().__init__(pmi, (0, 0, 0, 0), diameter, comp_mode)
+        super().__init__(pmi, diameter, spacing, parent)
+        self.code = pmi.OFF
 
 
 class DrawOverlappingCommand(DrawCommand):
     """
-    Like ``DrawCommand``, but accepts 2 PixmapItems instead of one, so that
+    Like ``DrawCommand``, but accepts 2 mask items instead of one, so that
     the drawing onto the first is only allowed if the same pixel is active in
-    the second.
+    the second. Masking is a vectorized intersection of the painted patch
+    with the reference, so it is about as fast as plain drawing.
     """
     COMMAND_NAME = "Draw Overlapping"
 
-    def __init__(self, pmi, ref_pmi, rgba, diameter,
-                 comp_mode=QtGui.QPainter.CompositionMode_Source, parent=None):
+    def __init__(self, pmi, ref_pmi, diameter, spacing=0.25, parent=None):
         """
-        :param ref_pmi: This ``PixmapItem`` should be of same shape as ``pmi``.
+        :param ref_pmi: This ``IndexedMaskItem`` should be of same shape as
+          ``pmi``.
         See ``DrawCommand`` docstrings for more info.
         """
-        super().__init__(pmi, rgba, diameter, comp_mode)
+        super().__init__(pmi, diameter, spacing, parent)
         self._reference_pmi = ref_pmi
+        # the active codes of the reference are frozen for the whole stroke,
+        # so every patch is masked by a lookup on the reference codes
+        self._reference_lut = ref_pmi.code_lut.copy()
 
-    def action(self, x_pos, y_pos):
+    def _mask_patch(self, rect, painted):
         """
-        Paint a circle on ``pmi`` at given position, masked by ``ref_pmi``.
+        Masks out the pixels of ``rect`` that are inactive in the reference.
         """
-        # get painter and set it up
-        painter = QtGui.QPainter(self.final_pixmap)
-        painter.setCompositionMode(self.comp_mode)
-        painter.setBrush(self.brush)
-        painter.setPen(self.pen)
-        #
-        diameter = self.diameter
-        radius = diameter // 2
-        xywh = (x_pos - radius, y_pos - radius, diameter, diameter)
-        #
-        # mask out the relevant region from the other mask: for that find the
-        # zeros, and mask out anything that IS a zero
-        other_pm = self._reference_pmi.pixmap().copy(QtCore.QRect(*xywh))
-        other_mask = other_pm.createMaskFromColor(
-            QtGui.QColor(0, 0, 0, a=0), mode=QtCore.Qt.MaskInColor)
-        other_region = QtGui.QRegion(other_mask)
-        # translate region to global coords and apply mask to painter
-        other_region.translate(x_pos - radius, y_pos - radius)
-        painter.setClipRegion(other_region)
-        # draw and refresh
-        painter.drawEllipse(QtCore.QRect(*xywh))
-        painter.end()
-        self.pmi.setPixmap(self.final_pixmap)
+        x0, y0 = rect.x(), rect.y()
+        ref_codes = self._reference_pmi.arr[y0:y0 + rect.height(),
+                                            x0:x0 + rect.width()]
+        painted &= self._reference_lut[ref_codes]
+        return painted
+
+
+# #############################################################################
+# ## UNDO STACK
+# #############################################################################
+class MemoryBudgetUndoStack(QtWidgets.QUndoStack):
+    """
+    A ``QUndoStack`` with a limit on the memory taken by its commands.
+    Commands that feature ``nbytes`` and ``evict`` methods (like
+    ``DrawCommand``) are accounted for, and when pushing exceeds the budget,
+    the oldest ones are evicted. Evicted commands can't be undone: undoing
+    up to them simply removes them from the stack.
+    """
+    def __init__(self, budget_bytes=None, parent=None):
+        """
+        :param budget_bytes: Maximal number of bytes that the commands in the
+          stack can hold. If ``None``, no limit. The most recent command is
+          never evicted, even if it exceeds the budget on its own.
+        """
+        super().__init__(parent)
+        self.budget_bytes = budget_bytes
+
+    def nbytes(self):
+        """
+        :returns: The number of bytes held by the commands in the stack.
+        """
+        return sum(self._command_nbytes(self.command(i))
+                   for i in range(self.count()))
+
+    @staticmethod
+    def _command_nbytes(cmd):
+        """
+        """
+        return cmd.nbytes() if hasattr(cmd, "nbytes") else 0
+
+    def push(self, cmd):
+        """
+        Pushes the command and evicts the oldest commands if needed.
+        """
+        super().push(cmd)
+        self.enforce_budget()
+
+    def enforce_budget(self):
+        """
+        Evicts the oldest commands until the budget is met (or only the most
+        recent command holds memory).
+        """
+        if self.budget_bytes is None:
+            return
+        # after pushing, the stack has no redo section, all commands are done
+        cmds = [self.command(i) for i in range(self.count())]
+        sizes = [self._command_nbytes(c) for c in cmds]
+        total = sum(sizes)
+        for cmd, size in zip(cmds[:-1], sizes[:-1]):
+            if total <= self.budget_bytes:
+                break
+            if size > 0:
+                cmd.evict()
+                total -= size
@@ -11,50 +11,368 @@ functionality to annotate.
 import numpy as np
 from PySide2 import QtCore, QtWidgets, QtGui
 #
-from .utils import RandomColorGenerator, rgb_arr_to_rgb_pixmap, \
-    bool_arr_to_rgba_pixmap, pixmap_to_arr
+from .utils import RandomColorGenerator, rgb_arr_to_rgb_pixmap
 from .mouse_event_manager import MouseEventManager
 from .objects import ObjectContainer
 
 
+# #############################################################################
+# ## LEVEL OF DETAIL HELPERS
+# #############################################################################
+def num_mip_levels(h, w, min_size):
+    """
+    :returns: The number of levels of a pyramid that starts with shape
+      ``(h, w)`` and halves the resolution at each level, until it fits in
+      ``min_size`` pixels.
+    """
+    largest = max(h, w)
+    num_levels = 1
+    while largest > min_size:
+        largest = (largest + 1) // 2
+        num_levels += 1
+    return num_levels
+
+
+def mip_level(painter, option, num_levels):
+    """
+    :param painter: The ``QPainter`` passed to a ``QGraphicsItem.paint``.
+    :param option: The ``QStyleOptionGraphicsItem`` passed to the same call.
+    :returns: The coarsest pyramid level with still at least one pixel per
+      device pixel, i.e. the level that matches the current zoom.
+    """
+    lod = option.levelOfDetailFromTransform(painter.worldTransform())
+    if lod >= 1:
+        return 0
+    return min(int(np.log2(1.0 / lod)), num_levels - 1)
+
+
+# #############################################################################
+# ## SCENE ITEMS
+# #############################################################################
+class TiledImageItem(QtWidgets.QGraphicsItem):
+    """
+    A scene item that displays an RGB image as a pyramid of tiled pixmaps:
+    each level has half the resolution of the prior one, and is split into
+    square tiles of fixed size. When painting, only the tiles that intersect
+    the exposed region are drawn, from the level that matches the zoom. This
+    way, the cost of panning and zooming doesn't grow with the image size.
+    """
+
+    def __init__(self, img_arr, tile_size=512, parent=None):
+        """
+        :param img_arr: Expects a ``np.uint8(h, w, 3)`` array.
+        :param tile_size: Width and height of the tiles, in pixels.
+        """
+        super().__init__(parent)
+        self.h, self.w, c = img_arr.shape
+        assert c == 3, "Only np.uint8 arrays of shape (h, w, 3) expected!"
+        self.tile_size = tile_size
+        num_levels = num_mip_levels(self.h, self.w, tile_size)
+        # each level is a tuple (scale_x, scale_y, rows_of_tile_pixmaps)
+        self.levels = []
+        img = QtGui.QImage(img_arr.data, self.w, self.h, img_arr.strides[0],
+                           QtGui.QImage.Format_RGB888)
+        for i in range(num_levels):
+            if i > 0:
+                img = img.scaled((img.width() + 1) // 2,
+                                 (img.height() + 1) // 2,
+                                 QtCore.Qt.IgnoreAspectRatio,
+                                 QtCore.Qt.SmoothTransformation)
+            lw, lh = img.width(), img.height()
+            tiles = [[QtGui.QPixmap.fromImage(
+                img.copy(x, y, min(tile_size, lw - x), min(tile_size, lh - y)))
+                      for x in range(0, lw, tile_size)]
+                     for y in range(0, lh, tile_size)]
+            self.levels.append((self.w / lw, self.h / lh, tiles))
+        #
+        self.setFlag(QtWidgets.QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self):
+        """
+        """
+        return QtCore.QRectF(0, 0, self.w, self.h)
+
+    def paint(self, painter, option, widget=None):
+        """
+        Draws the exposed tiles from the level that matches the zoom.
+        """
+        sx, sy, tiles = self.levels[mip_level(painter, option,
+                                              len(self.levels))]
+        rect = option.exposedRect
+        ts = self.tile_size
+        row_beg = max(0, int(rect.top() / sy) // ts)
+        row_end = min(len(tiles), int(rect.bottom() / sy) // ts + 1)
+        col_beg = max(0, int(rect.left() / sx) // ts)
+        col_end = min(len(tiles[0]), int(rect.right() / sx) // ts + 1)
+        for row in range(row_beg, row_end):
+            for col in range(col_beg, col_end):
+                pm = tiles[row][col]
+                target = QtCore.QRectF(col * ts * sx, row * ts * sy,
+                                       pm.width() * sx, pm.height() * sy)
+                painter.drawPixmap(target, pm, QtCore.QRectF(pm.rect()))
+
+
+class IndexedMaskItem(QtWidgets.QGraphicsItem):
+    """
+    A scene item that displays a ``np.uint8(h, w)`` array of codes through a
+    256-entry color table: the codes that are active in the ``code_lut``
+    are shown with the mask color, and the rest are transparent. This way,
+    changing the color or the active codes doesn't depend on the image size.
+
+    The ``OFF`` and ``ON`` codes are reserved for pixels that are always
+    inactive and active, respectively. Binary masks only use those two, so
+    their codes are also a valid boolean buffer (see ``as_bool_arr``).
+
+    Optionally, the item keeps a pyramid of subsampled copies of the codes,
+    and paints from the level that matches the current zoom. The pyramid has
+    to be kept in sync via ``sync_levels`` whenever ``arr`` is modified.
+    Editors are expected to write into ``arr`` directly, and then call
+    ``update_region`` with the bounding box of the modified pixels, so that
+    the cost of an edit depends on its size, not on the size of the mask.
+    """
+    OFF = 0
+    ON = 1
+    NUM_RESERVED_CODES = 2
+    REFRESH_INTERVAL_MS = 15  # see schedule_update
+
+    def __init__(self, codes, rgba, code_lut=None, num_levels=1,
+                 parent=None):
+        """
+        :param codes: A ``np.uint8(h, w)`` array. It will be copied.
+        :param rgba: Color of the active pixels, 4 values between 0 and 255.
+        :param code_lut: A ``np.bool(256)`` array telling which codes are
+          active. If not given, only ``ON`` is active.
+        :param num_levels: Number of levels of the pyramid. Each level
+          subsamples the prior one by a factor of 2. If 1, no pyramid.
+        """
+        super().__init__(parent)
+        self.h, self.w = codes.shape
+        # Qt expects 32-bit aligned scanlines, so the buffers may be wider
+        self._buffers = []
+        self.levels = []
+        for i in range(num_levels):
+            step = 2 ** i
+            lh, lw = -(-self.h // step), -(-self.w // step)
+            buf = np.zeros((lh, (lw + 3) & ~3), dtype=np.uint8)
+            self._buffers.append(buf)
+            self.levels.append(buf[:, :lw])
+        self.arr = self.levels[0]
+        self.arr[:] = codes
+        self.sync_levels()
+        # if true, arr only holds OFF and ON. Editors keep it that way
+        self.binary = not (self.arr > self.ON).any()
+        #
+        self.rgba = rgba
+        self.code_lut = np.zeros(256, dtype=np.bool)
+        if code_lut is None:
+            self.code_lut[self.ON] = True
+        else:
+            self.code_lut[:] = code_lut
+        self.code_lut[self.OFF] = False
+        self.code_lut[self.ON] = True
+        self.qimgs = []
+        self.qimg = None
+        self._make_qimages()
+        #
+        self._dirty_region = None
+        self._refresh_timer = QtCore.QTimer()
+        self._refresh_timer.setSingleShot(True)
+        self._refresh_timer.setInterval(self.REFRESH_INTERVAL_MS)
+        self._refresh_timer.timeout.connect(self.flush_updates)
+        self.setFlag(QtWidgets.QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def _make_qimages(self):
+        """
+        (Re)creates the ``Indexed8`` images that share memory with the codes
+        of each level, with a color table given by ``self.rgba`` and
+        ``self.code_lut``. Fresh images are created every time to prevent
+        that changing the color table detaches them from the buffers.
+        """
+        active = QtGui.QColor(*self.rgba).rgba()
+        table = [active if c else 0 for c in self.code_lut]
+        self.qimgs = []
+        for buf, lvl in zip(self._buffers, self.levels):
+            lh, lw = lvl.shape
+            qimg = QtGui.QImage(buf.data, lw, lh, buf.strides[0],
+                                QtGui.QImage.Format_Indexed8)
+            qimg.setColorTable(table)
+            self.qimgs.append(qimg)
+        self.qimg = self.qimgs[0]
+
+    def sync_levels(self, x0=0, y0=0, x1=None, y1=None):
+        """
+        Updates the pyramid levels in the given region of ``arr``. Call this
+        after modifying ``arr``. By default, the whole pyramid is updated.
+        """
+        x1 = self.w if x1 is None else x1
+        y1 = self.h if y1 is None else y1
+        for i, lvl in enumerate(self.levels[1:], 1):
+            step = 2 ** i
+            # level pixel j is the arr pixel j*step
+            ly0, lx0 = -(-y0 // step), -(-x0 // step)
+            ly1, lx1 = -(-y1 // step), -(-x1 // step)
+            lvl[ly0:ly1, lx0:lx1] = self.arr[ly0 * step:ly1 * step:step,
+                                             lx0 * step:lx1 * step:step]
+
+    def update_region(self, x0=0, y0=0, x1=None, y1=None):
+        """
+        Call this after modifying ``arr`` inside the ``[y0:y1, x0:x1]``
+        region: syncs the pyramid and schedules a repaint of that region only.
+        By default, the whole item is updated.
+        """
+        x1 = self.w if x1 is None else x1
+        y1 = self.h if y1 is None else y1
+        self.sync_levels(x0, y0, x1, y1)
+        self.update(QtCore.QRectF(x0, y0, x1 - x0, y1 - y0))
+
+    def schedule_update(self, x0, y0, x1, y1):
+        """
+        Like ``update_region``, but throttled: regions are accumulated and
+        updated together at most once every ``REFRESH_INTERVAL_MS``. Useful
+        for interactive edits that modify ``arr`` many times per frame. Call
+        ``flush_updates`` to update immediately.
+        """
+        if self._dirty_region is None:
+            self._dirty_region = (x0, y0, x1, y1)
+            self._refresh_timer.start()
+        else:
+            dx0, dy0, dx1, dy1 = self._dirty_region
+            self._dirty_region = (min(x0, dx0), min(y0, dy0),
+                                  max(x1, dx1), max(y1, dy1))
+
+    def flush_updates(self):
+        """
+        Performs the updates pending from ``schedule_update``, if any.
+        """
+        self._refresh_timer.stop()
+        if self._dirty_region is not None:
+            region, self._dirty_region = self._dirty_region, None
+            self.update_region(*region)
+
+    def boundingRect(self):
+        """
+        """
+        return QtCore.QRectF(0, 0, self.w, self.h)
+
+    def paint(self, painter, option, widget=None):
+        """
+        Draws only the exposed region of the item, from the pyramid level
+        that matches the zoom.
+        """
+        rect = option.exposedRect
+        level = mip_level(painter, option, len(self.levels))
+        step = 2 ** level
+        source = QtCore.QRectF(rect.x() / step, rect.y() / step,
+                               rect.width() / step, rect.height() / step)
+        painter.drawImage(rect, self.qimgs[level], source)
+
+    def set_color(self, rgba=None, code_lut=None):
+        """
+        :param rgba: If given, the new color for the active codes.
+        :param code_lut: If given, the new ``np.bool(256)`` active codes.
+          The reserved codes keep their meaning.
+        """
+        if rgba is not None:
+            self.rgba = rgba
+        if code_lut is not None:
+            self.code_lut[:] = code_lut
+            self.code_lut[self.OFF] = False
+            self.code_lut[self.ON] = True
+        self._make_qimages()
+        self.update()
+
+    def as_bool_arr(self):
+        """
+        :returns: A ``np.bool(h, w)`` array, true where the codes are active.
+          If the mask is ``binary``, this is a read-only view of ``arr``
+          without any copy, so it will reflect further edits. Otherwise it
+          is a new array.
+        """
+        if self.binary:
+            view = self.arr.view(np.bool)
+            view.flags.writeable = False
+            return view
+        return self.code_lut[self.arr]
+
+
 # #############################################################################
 # ## SCENE (PAINT ETC)
 # #############################################################################
 class MaskedImageScene(QtWidgets.QGraphicsScene, ObjectContainer):
     """
     Basic area that allows to display a color image, together with a set of
-    binary masks on top of it.
+    masks on top of it. Masks are ``IndexedMaskItem`` s.
+
+    In tiled mode, the image is a ``TiledImageItem`` and the masks keep a
+    pyramid of levels, so that only the visible part is drawn, at the
+    resolution that matches the zoom. Recommended for large images.
     """
     DEFAULT_MASK_ALPHA = 100  # 255 is opaque. Used if no colors are specified
 
-    def __init__(self, img_arr=None, parent=None):
+    def __init__(self, img_arr=None, parent=None, tile_size=None):
         """
         :param img_arr: See ``update_image``
+        :param tile_size: If given, the scene works in tiled mode, with tiles
+          of this many pixels per side.
         """
         # super().__init__(parent)
         QtWidgets.QGraphicsScene.__init__(self, parent)
         ObjectContainer.__init__(self)
         #
+        self.tile_size = tile_size
         self.img_pmi = None
         self.h = None
         self.w = None
+        self.num_levels = 1
         #
         self.mask_pmis = {}  # pmi_ref : (r, g, b, a)
         if img_arr is not None:
             self.update_image(img_arr)
 
-    def update_image(self, img_arr):
+    def update_image(self, img_arr=None, shape=None):
         """
-        Clears whole scene, and adds the given numpy array as Pixmap.
+        Clears whole scene, and adds the given numpy array as Pixmap (or as
+        ``TiledImageItem`` in tiled mode).
 
-        :param img_arr: A ``np.uint8(h, w [, ?])`` array.
+        :param img_arr: A ``np.uint8(h, w [, ?])`` array. If ``None``, the
+          scene starts without image, which can be added later via
+          ``replace_image``.
+        :param shape: The ``(h, w)`` shape of the scene. Only needed if it
+          differs from the image's, which will then be stretched to it.
         """
-        pm = rgb_arr_to_rgb_pixmap(img_arr)
         self.clear()
-        self.img_pmi = self.addPixmap(pm)
-        #
-        self.h, self.w = img_arr.shape[:2]
+        self.img_pmi = None
+        self.mask_pmis = {}
+        self.h, self.w = img_arr.shape[:2] if shape is None else shape
         self.setSceneRect(0, 0, self.w, self.h)
+        if self.tile_size is not None:
+            self.num_levels = num_mip_levels(self.h, self.w, self.tile_size)
+        if img_arr is not None:
+            self.replace_image(img_arr)
+
+    def replace_image(self, img_arr):
+        """
+        Replaces the image, keeping the rest of the scene (masks, objects...)
+        untouched. The image always stays underneath the rest of the items.
+
+        :param img_arr: A ``np.uint8(h, w [, ?])`` array. If its shape differs
+          from the scene's (e.g. a downscaled preview), it will be stretched
+          to fit the scene.
+        """
+        if self.tile_size is None:
+            pmi = QtWidgets.QGraphicsPixmapItem(
+                rgb_arr_to_rgb_pixmap(img_arr))
+        else:
+            pmi = TiledImageItem(img_arr, self.tile_size)
+        h, w = img_arr.shape[:2]
+        if (h, w) != (self.h, self.w):
+            pmi.setTransform(QtGui.QTransform.fromScale(self.w / w,
+                                                        self.h / h))
+        pmi.setZValue(-1)
+        if self.img_pmi is not None:
+            self.removeItem(self.img_pmi)
+        self.addItem(pmi)
+        self.img_pmi = pmi
 
     def num_items(self):
         """
@@ -71,16 +389,20 @@ class MaskedImageScene(QtWidgets.QGraphicsScene, ObjectContainer):
         o = QtCore.Qt.AscendingOrder if ascending else QtCore.Qt.AscendingOrder
         return super().items(o)
 
-    def add_mask(self, mask_arr, rgba=None, item_on_top=None):
+    def add_mask(self, mask_arr, rgba=None, item_on_top=None, code_lut=None):
         """
-        :param mask_arr: A ``np.bool(h, w)`` array.
+        :param mask_arr: A ``np.bool(h, w)`` array. Alternatively, if
+          ``code_lut`` is given, a ``np.uint8(h, w)`` array of codes.
         :param item_on_top: If given, mask will be added underneath that item.
           Otherwise will be added on top of item stack.
-        :returns: The added ``PixmapItem``.
+        :param code_lut: See ``IndexedMaskItem``.
+        :returns: The added ``IndexedMaskItem``.
         """
         # sanity check mask
-        assert mask_arr.dtype == np.bool, "Mask must be np.bool(h, w)!"
-        assert len(mask_arr.shape) == 2, "Mask must be np.bool(h, w)!"
+        expected_dtype = np.bool if code_lut is None else np.uint8
+        assert mask_arr.dtype == expected_dtype, \
+            "Mask must be {}(h, w)!".format(expected_dtype.__name__)
+        assert len(mask_arr.shape) == 2, "Mask must be 2-dimensional!"
         assert mask_arr.shape == (self.h, self.w), \
             "Mask must have same (h, w) as image!"
         # sanity check color
@@ -89,9 +411,14 @@ class MaskedImageScene(QtWidgets.QGraphicsScene, ObjectContainer):
             rgba = (r, g, b, self.DEFAULT_MASK_ALPHA)
         assert all([0 <= c <= 255 for c in rgba]), \
             "RGBA must be in [0, 255] range!"
-        # add pixmap: if this fails, the method raises with no side effect
-        pm = bool_arr_to_rgba_pixmap(mask_arr, rgba)
-        pmi = self.addPixmap(pm)
+        # add item: if this fails, the method raises with no side effect.
+        # Booleans are converted to uint8, i.e. to OFF and ON codes. Their
+        # bytes aren't necessarily 0/1 (e.g. PIL's 1-bit images use 255)
+        if code_lut is None:
+            mask_arr = (mask_arr != 0).view(np.uint8)
+        pmi = IndexedMaskItem(mask_arr, rgba, code_lut,
+                              self.num_levels)
+        self.addItem(pmi)
         self.mask_pmis[pmi] = rgba
         # now we have side FX: if this fails roll back the add Pixmap
         if item_on_top is not None:
@@ -118,7 +445,8 @@ class MaskedImageScene(QtWidgets.QGraphicsScene, ObjectContainer):
         del self.mask_pmis[pmi]
         return rgba
 
-    def replace_mask_pmi(self, pmi, new_mask_arr, new_rgba=None):
+    def replace_mask_pmi(self, pmi, new_mask_arr, new_rgba=None,
+                         code_lut=None):
         """
         If we call ``remove_mask`` and then ``add_mask`` fails, we will lose
         the removed mask forever. This method updates the mask in an atomary
@@ -133,22 +461,27 @@ class MaskedImageScene(QtWidgets.QGraphicsScene, ObjectContainer):
         old_rgba = self.mask_pmis[pmi]
         if new_rgba is None:
             new_rgba = old_rgba
-        new_pmi = self.add_mask(new_mask_arr, rgba=new_rgba, item_on_top=pmi)
+        new_pmi = self.add_mask(new_mask_arr, new_rgba, pmi, code_lut)
         self.remove_mask(pmi)
         return new_pmi
 
+    def change_mask_color(self, pmi, rgba=None, code_lut=None):
+        """
+        Changes the color and/or the active codes of the given mask in place.
+        See ``IndexedMaskItem.set_color``.
+        """
+        assert pmi in self.mask_pmis, "Given Item is not in mask_pmis!"
+        pmi.set_color(rgba, code_lut)
+        self.mask_pmis[pmi] = pmi.rgba
+
     def mask_as_bool_arr(self, pmi):
         """
         Asserts that the given ``pmi`` is in ``self.mask_pmis``, and returns
-        the map as ``np.bool(h, w)`` array, in which all non-zero values are
-        true.
+        the map as ``np.bool(h, w)`` array, in which all active values are
+        true. See ``IndexedMaskItem.as_bool_arr``.
         """
         assert pmi in self.mask_pmis, "Given Item is not in mask_pmis!"
-        # a has shape (h, w, 4) where 4->RGBA
-        pixmap_format = QtGui.QImage.Format_RGBA8888
-        arr = pixmap_to_arr(pmi.pixmap(), pixmap_format)
-        mask = (arr > 0).any(axis=-1)
-        return mask
+        return pmi.as_bool_arr()
 
 
 # #############################################################################
@@ -8,12 +8,17 @@ else in the project.
 
 
 import os
+import re
+import json
+import struct
+import zipfile
 import itertools
+import threading
 from pathlib import Path
 #
 import numpy as np
 import randomcolor
-from PIL import Image
+from PIL import Image, ImageOps
 import exifread
 from PySide2 import QtGui
 
@@ -54,6 +59,9 @@ def unique_filename(path, suffix="_({})", max_iters=10000):
     Given a path, returns the same path if unique, or adds ``(N)`` before the
     extension to make it unique, for ``N`` being the lowest integer possible
     starting from 1.
+
+    Every candidate is checked on disk. To save many files into the same
+    folder, see ``UniqueFilenameAllocator``.
     """
     if not Path(path).is_file():
         return path
@@ -66,6 +74,116 @@ def unique_filename(path, suffix="_({})", max_iters=10000):
             assert i < max_iters, "max no. of iters reached!"
 
 
+class UniqueFilenameAllocator:
+    """
+    Like ``unique_filename``, for many files saved into the same folders.
+    Each folder is listed only once, and the highest ``N`` used for each
+    name is remembered, so allocating a path doesn't need to check every
+    candidate on disk. Usage example::
+
+      allocate = UniqueFilenameAllocator()
+      path = allocate("/out/img.png_annot.png")  # e.g. img.png_annot_(4).png
+      save(arr, path)
+
+    Allocated paths are reserved by creating them as empty files, with
+    exclusive creation (``O_EXCL``). This way, other allocators (e.g. other
+    sessions saving into the same folder) never return the same path. Gaps
+    in the numbering (e.g. removed files) are not reused.
+    """
+    def __init__(self, suffix="_({})", max_iters=10000):
+        """
+        :param suffix: See ``unique_filename``.
+        :param max_iters: Maximal number of paths that can be found taken
+          (e.g. by other sessions) during a single allocation.
+        """
+        before, after = suffix.split("{}")
+        self.suffix = suffix
+        self.max_iters = max_iters
+        self._suffix_re = re.compile(
+            "(.*)" + re.escape(before) + r"(\d+)" + re.escape(after),
+            re.DOTALL)
+        # dirname: (set of listed (prefix, ext), {(prefix, ext): highest N})
+        self._dirs = {}
+        self._next_idx = {}  # (dirname, prefix, ext): next N to try
+        self._lock = threading.Lock()
+
+    def _list_dir(self, dirname):
+        """
+        Lists ``dirname`` and indexes its names by prefix and extension. E.g.
+        ``a.png`` and ``a_(3).png`` give ``{("a", ".png")}`` and
+        ``{("a", ".png"): 3}``.
+        """
+        plain, highest = set(), {}
+        with os.scandir(dirname or ".") as it:
+            for e in it:
+                prefix, ext = os.path.splitext(e.name)
+                plain.add((prefix, ext))
+                m = self._suffix_re.fullmatch(prefix)
+                if m is not None:
+                    key = (m.group(1), ext)
+                    highest[key] = max(highest.get(key, 0), int(m.group(2)))
+        self._dirs[dirname] = (plain, highest)
+
+    def _scan(self, dirname, prefix, ext):
+        """
+        :returns: A tuple ``(is_taken, idx)``, where ``is_taken`` tells if
+          the plain name is in the (cached) listing of ``dirname``, and
+          ``idx`` is the ``N`` following the highest one found there.
+        """
+        if dirname not in self._dirs:
+            self._list_dir(dirname)
+        plain, highest = self._dirs[dirname]
+        key = (prefix, ext)
+        return (key in plain), highest.get(key, 0) + 1
+
+    @staticmethod
+    def _reserve(path):
+        """
+        :returns: True if ``path`` didn't exist and was created, False if it
+          already existed.
+        """
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        return True
+
+    def __call__(self, path):
+        """
+        :returns: ``path`` if it didn't exist, otherwise ``path`` with
+          ``suffix`` before the extension, for ``N`` higher than any used
+          before. The returned path exists as an empty file.
+        :raises: ``RuntimeError`` if ``max_iters`` taken paths were found.
+          ``OSError`` if the folder doesn't exist.
+        """
+        dirname, name = os.path.split(path)
+        prefix, ext = os.path.splitext(name)
+        key = (dirname, prefix, ext)
+        with self._lock:
+            idx = self._next_idx.get(key)
+            if idx is None:
+                is_taken, idx = self._scan(dirname, prefix, ext)
+                self._next_idx[key] = idx
+                if not is_taken and self._reserve(path):
+                    return path
+            for _ in range(self.max_iters):
+                p = os.path.join(
+                    dirname, prefix + self.suffix.format(idx) + ext)
+                idx += 1
+                self._next_idx[key] = idx
+                if self._reserve(p):
+                    return p
+            raise RuntimeError("max no. of iters reached!")
+
+    def clear(self):
+        """
+        Forgets the listed folders, e.g. if they were modified externally.
+        """
+        with self._lock:
+            self._dirs.clear()
+            self._next_idx.clear()
+
+
 # #############################################################################
 # ## NUMPY <-> QT_PIXMAP INTERFACING
 # #############################################################################
@@ -86,9 +204,16 @@ def bool_arr_to_rgba_pixmap(arr, rgba=(255, 0, 0, 255)):
     """
     :param arr: Expects a ``np.bool(h, w)`` array.
     :param rgba: 4 values between 0 and 255. Alpha=255 means full opacity.
-    :returns: A ``QtGui.QPixmap`` in format ``RGBA8888(w, h)``, where the
-      ``false`` values are all zeros and the ``true`` values have the specified
+    :returns: A ``QtGui.QPixmap`` of shape ``(w, h)``, where the ``false``
+      values are all zeros and the ``true`` values have the specified
       ``rgba`` color.
+
+    The mask is converted to ``np.uint8`` codes (0 or 1) and wrapped as an
+    ``Indexed8`` image with a 2-entry color table, so the only copies are
+    the codes and the conversion to pixmap.
+
+    The scene doesn't call this since masks are ``IndexedMaskItem`` tiles,
+    but it is kept as a public helper for showing masks as plain pixmaps.
     """
     # When painting ``(r, g, b, 0)`` Qt actually paints ``(0, 0, 0, 0)``. The
     # workaround of inverting all pixel values before and after painting
@@ -97,13 +222,12 @@ def bool_arr_to_rgba_pixmap(arr, rgba=(255, 0, 0, 255)):
     # also topic/88000/qpainter-loosing-color-of-transparent-pixels-critical
     assert rgba[-1] > 0, "Alpha can't be zero, Qt will delete all :("
     h, w = arr.shape
-    marr = np.zeros((h, w, 4), dtype=np.uint8)
-    y_idxs, x_idxs = np.where(arr)
-    marr[y_idxs, x_idxs] = rgba
-    # HERE WOULD COME THE BUGFIX: try harder the "invert colors" approach?
-    #
-    img = QtGui.QImage(marr.data, w, h, marr.strides[0],
-                       QtGui.QImage.Format_RGBA8888)
+    # bool bytes aren't necessarily 0/1 (e.g. PIL's 1-bit images use 255),
+    # and other values would index past the color table
+    codes = (arr != 0).view(np.uint8)
+    img = QtGui.QImage(codes.data, w, h, codes.strides[0],
+                       QtGui.QImage.Format_Indexed8)
+    img.setColorTable([0, QtGui.QColor(*rgba).rgba()])
     #
     pm = QtGui.QPixmap.fromImage(img)
     return pm
@@ -117,19 +241,51 @@ def pixmap_to_arr(pm, img_format=QtGui.QImage.Format_RGBA8888):
     :returns: A ``np.uint8(h, w, C)`` array, where the number of channels ``C``
       depends on the image format.
 
+    The pixmap is painted directly into the returned array, wrapped as a
+    ``QImage`` of the given format, so there is a single copy. Formats that
+    can't be painted on (e.g. indexed) are converted and then copied. Formats
+    with less than 8 bits per pixel are not supported.
+
+    Masks in the scene are read back with ``mask_as_bool_arr`` instead, so
+    this is a public helper for inspecting arbitrary pixmaps (e.g. in tests).
+
     ..note::
       Pixmaps are in format (w, h, ...) but arrays are returned
       in ``(h, w, ...)``, as usual for numpy
     """
-    img = pm.toImage().convertToFormat(img_format)
-    w, h = img.size().toTuple()
-    arr = np.array(img.constBits()).reshape(h, w, -1)
+    w, h = pm.width(), pm.height()
+    num_chans = QtGui.QImage(1, 1, img_format).depth() // 8
+    arr = np.empty((h, w, num_chans), dtype=np.uint8)
+    img = QtGui.QImage(arr.data, w, h, arr.strides[0], img_format)
+    painter = QtGui.QPainter()
+    # QPainter can't paint on indexed images, and complains if tried
+    if img_format != QtGui.QImage.Format_Indexed8 and painter.begin(img):
+        painter.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
+        painter.drawPixmap(0, 0, pm)
+        painter.end()
+    else:
+        img = pm.toImage().convertToFormat(img_format)
+        # scanlines may be padded, and the buffer dies with img: copy now
+        rows = np.frombuffer(img.constBits(), dtype=np.uint8).reshape(
+            h, img.bytesPerLine())
+        arr[:] = rows[:, :w * num_chans].reshape(h, w, num_chans)
     return arr
 
 
 # #############################################################################
 # ## IMAGE I/O
 # #############################################################################
+EXIF_ORIENTATION_TAG = 0x0112
+# lossless transpositions that bring each EXIF orientation to the normal one
+EXIF_ORIENTATION_TRANSPOSES = {2: Image.FLIP_LEFT_RIGHT,
+                               3: Image.ROTATE_180,
+                               4: Image.FLIP_TOP_BOTTOM,
+                               5: Image.TRANSPOSE,
+                               6: Image.ROTATE_270,
+                               7: Image.TRANSVERSE,
+                               8: Image.ROTATE_90}
+
+
 def load_exif(img_path):
     """
     :returns: A dictionary with the EXIF data contained at ``img_path``.
@@ -139,38 +295,199 @@ def load_exif(img_path):
         return exif_dict
 
 
+def read_img_shape(img_path):
+    """
+    :returns: The ``(h, w)`` shape of the image at the given path, after
+      applying its EXIF orientation. Only the header is read.
+    """
+    with Image.open(img_path) as image:
+        w, h = image.size
+        orientation = image.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    # orientations 5 to 8 swap width and height
+    return (w, h) if orientation in (5, 6, 7, 8) else (h, w)
+
+
+def load_img_preview(img_path, max_side=1024):
+    """
+    Loads a downscaled version of the image at the given path, with its EXIF
+    orientation applied. This is only fast for formats that can be decoded
+    at reduced scale (i.e. JPEG), so other formats are not loaded.
+
+    :param max_side: The preview is decoded at the smallest scale that has
+      at least this many pixels per side (or at full scale if smaller).
+    :returns: A ``np.uint8(h, w, 3)`` array, or ``None`` if the image can't
+      be decoded at reduced scale.
+    """
+    with Image.open(img_path) as image:
+        if image.format != "JPEG":
+            return None
+        image.draft("RGB", (max_side, max_side))
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        return np.asarray(image)
+
+
 def load_img_and_exif(img_path: str, as_np_array=True,
-                      ignore_alpha=True):
+                      ignore_alpha=True, full_exif=False):
     """
     Loads the image at given path using PIL, and its EXIF data. If the EXIF
-    data contains extra info about orientation, also rotates the image
-    accordingly.
+    data contains extra info about orientation, also transposes the image
+    accordingly (this is lossless, no resampling is involved).
 
     :param as_np_array: If true, the image will be converted from PIL format
       to np via ``np.asarray(image)``
     :param ignore_alpha: If the type of the image is ``RGBA``, it will be
       converted to ``RGB``.
+    :param full_exif: By default, the returned EXIF data is the one parsed
+      by PIL when opening the image (a ``PIL.Image.Exif`` mapping numeric tags
+      to values). If true, the file is additionally parsed by ``load_exif``,
+      which is slower but returns all tags by name.
 
-    :returns: A tuple ``(image, exif_dict)``.
-
-    Inspired in https://stackoverflow.com/a/26928142
-    """
-    exif_dict = load_exif(img_path)
-    image = Image.open(img_path)
-    if ignore_alpha and image.mode == "RGBA":
-        image = image.convert("RGB")
-
-    # Img orientation seems to have tag 274
-    try:
-        orientation: int = exif_dict["Image Orientation"].values[0]
-        if orientation == 3:
-            image = image.rotate(180, expand=True)
-        elif orientation == 6:
-            image = image.rotate(270, expand=True)
-        elif orientation == 8:
-            image = image.rotate(90, expand=True)
-    except KeyError:
-        pass
+    :returns: A tuple ``(image, exif)``.
+    """
+    with Image.open(img_path) as image:
+        exif = image.getexif()
+        if ignore_alpha and image.mode == "RGBA":
+            image = image.convert("RGB")
+        else:
+            image.load()
+    transpose = EXIF_ORIENTATION_TRANSPOSES.get(
+        exif.get(EXIF_ORIENTATION_TAG, 1))
+    if transpose is not None:
+        image = image.transpose(transpose)
+    if full_exif:
+        exif = load_exif(img_path)
     if as_np_array:
         image = np.asarray(image)
-    return image, exif_dict
+    return image, exif
+
+
+# #############################################################################
+# ## NUMPY I/O
+# #############################################################################
+def load_npz_array(npz_path, name, mmap_mode="r"):
+    """
+    Loads a single array from a ``.npz`` archive. If it was stored without
+    compression (i.e. with ``np.savez`` instead of ``np.savez_compressed``),
+    it is memory-mapped instead, which takes no time and no memory until the
+    contents are accessed.
+
+    :param name: Name of the array in the archive, e.g. ``arr`` for
+      ``np.savez(path, arr=arr)``.
+    :param mmap_mode: See ``np.memmap``. If ``None``, the array is always
+      loaded.
+    :raises: ``KeyError`` if the archive has no array with that name.
+    """
+    with zipfile.ZipFile(npz_path) as zf:
+        info = zf.getinfo(name + ".npy")
+        if mmap_mode is not None and \
+           info.compress_type == zipfile.ZIP_STORED:
+            with zf.open(info) as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    header = np.lib.format.read_array_header_1_0(f)
+                elif version == (2, 0):
+                    header = np.lib.format.read_array_header_2_0(f)
+                else:
+                    header = None
+                header_size = f.tell()
+        else:
+            header = None
+    if header is None or header[2].hasobject:
+        return np.load(npz_path)[name]
+    shape, fortran_order, dtype = header
+    # the member data follows its local header, of variable length
+    with open(npz_path, "rb") as f:
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+    name_len, extra_len = struct.unpack("<HH", local_header[26:30])
+    offset = info.header_offset + 30 + name_len + extra_len + header_size
+    return np.memmap(npz_path, dtype=dtype, mode=mmap_mode, offset=offset,
+                     shape=shape, order="F" if fortran_order else "C")
+
+
+# #############################################################################
+# ## MASK I/O
+# #############################################################################
+def bool_arr_to_rle(arr):
+    """
+    :param arr: A ``np.bool(h, w)`` array.
+    :returns: The uncompressed COCO run-length encoding of ``arr``, i.e. a
+      dictionary ``{"size": [h, w], "counts": [...]}``, where the counts are
+      the lengths of the alternating runs of false and true values (starting
+      with false), traversing the array in column-major order.
+    """
+    flat = arr.ravel(order="F")
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [flat.size]))
+    counts = np.diff(bounds)
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return {"size": list(arr.shape), "counts": counts.tolist()}
+
+
+def rle_to_bool_arr(rle):
+    """
+    Inverse of ``bool_arr_to_rle``.
+    """
+    h, w = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    assert counts.sum() == h * w, "RLE counts don't match its size!"
+    values = np.arange(len(counts)) % 2 == 1
+    return np.repeat(values, counts).reshape((h, w), order="F")
+
+
+def save_bool_arr(arr, outpath, png_compress_level=1):
+    """
+    Saves a boolean mask to ``outpath``. The format is given by its
+    (case-insensitive) extension:
+
+    * ``.npz``: The mask as bits (``np.packbits``), together with its shape.
+      This is the fastest format, and takes 1 bit per pixel.
+    * ``.json``: The COCO run-length encoding, see ``bool_arr_to_rle``.
+      This is the smallest format for masks with few, large regions.
+    * Otherwise, an image where false is black and true is white. For
+      ``.png``, the image has 1 bit per pixel and is compressed with the
+      given zlib ``png_compress_level`` (from 0 to 9).
+
+    Masks in any of these formats can be read with ``load_bool_arr``.
+    """
+    ext = os.path.splitext(outpath)[1].lower()
+    if ext == ".npz":
+        # a file object prevents np.savez from appending its own extension
+        with open(outpath, "wb") as f:
+            np.savez(f, shape=arr.shape, bits=np.packbits(arr, axis=None))
+    elif ext == ".json":
+        with open(outpath, "w") as f:
+            json.dump(bool_arr_to_rle(arr), f)
+    elif ext == ".png":
+        Image.fromarray(arr).save(outpath, compress_level=png_compress_level)
+    else:
+        Image.fromarray(arr).save(outpath)
+
+
+def load_bool_arr(path):
+    """
+    Loads a mask saved with ``save_bool_arr``, or any image supported by
+    PIL, where zero pixels are considered false and non-zero true.
+
+    :returns: A ``np.bool(h, w)`` array.
+    :raises: ``RuntimeError`` if the image is not rank 2 or 3.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".npz":
+        with np.load(path) as npz:
+            shape = tuple(npz["shape"])
+            bits = npz["bits"]
+        arr = np.unpackbits(bits, count=int(np.prod(shape)))
+        return arr.view(np.bool).reshape(shape)
+    if ext == ".json":
+        with open(path, "r") as f:
+            return rle_to_bool_arr(json.load(f))
+    arr = load_img_and_exif(path)[0]
+    # no shortcut for bool arrays: PIL's 1-bit images have 255 as true bytes
+    if len(arr.shape) == 2:
+        return arr != 0
+    elif len(arr.shape) == 3:
+        return arr.any(axis=-1)
+    else:
+        raise RuntimeError("Mask must be rank 2 or 3!")
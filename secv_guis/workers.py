@@ -0,0 +1,234 @@
+# -*- coding:utf-8 -*-
+
+
+"""
+This module contains helpers to run slow tasks (like decoding big images) on
+worker threads, away from the GUI thread, and to cache their results.
+"""
+
+
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+#
+from PySide2 import QtCore
+
+
+# #############################################################################
+# ## CACHING
+# #############################################################################
+class LRUCache:
+    """
+    A dictionary-like container that holds at most ``max_items`` elements.
+    When full, adding an element discards the least recently used one.
+    """
+    def __init__(self, max_items, on_evict=None):
+        """
+        :param max_items: Maximal number of elements in the cache.
+        :param on_evict: If given, a function ``on_evict(key, value)`` that
+          will be called for every discarded element.
+        """
+        assert max_items > 0, "The cache must hold at least 1 element!"
+        self.max_items = max_items
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        """
+        """
+        return key in self._data
+
+    def __len__(self):
+        """
+        """
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        :returns: The value for ``key``, which becomes the most recently used,
+          or ``default`` if not in the cache.
+        """
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key, value):
+        """
+        Adds the element as the most recently used, discarding the least
+        recently used ones if needed.
+        """
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_items:
+            old_key, old_val = self._data.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(old_key, old_val)
+
+    def values(self):
+        """
+        :returns: A list with the cached values, from least to most recently
+          used.
+        """
+        return list(self._data.values())
+
+    def pop(self, key, default=None):
+        """
+        Removes the element (without calling ``on_evict``) and returns it.
+        """
+        return self._data.pop(key, default)
+
+    def clear(self):
+        """
+        """
+        self._data.clear()
+
+
+# #############################################################################
+# ## QT INTERFACING
+# #############################################################################
+class FutureSignaler(QtCore.QObject):
+    """
+    Bridges ``concurrent.futures`` and Qt: the callbacks passed to ``watch``
+    are called in the thread of this object (typically the GUI thread) once
+    the future is done, via a queued signal. Usage example::
+
+      signaler = FutureSignaler(parent=some_widget)
+      fut = executor.submit(slow_fn)
+      signaler.watch(fut, lambda result: widget.show_result(result),
+                     lambda exc: widget.show_error(exc))
+    """
+    _done = QtCore.Signal(object, object, object)
+
+    def __init__(self, parent=None):
+        """
+        """
+        super().__init__(parent)
+        self._done.connect(self._handle_done)
+
+    def watch(self, fut, on_result, on_error=None):
+        """
+        :param fut: A ``concurrent.futures.Future``.
+        :param on_result: Function to be called with the result of ``fut``.
+        :param on_error: Function to be called with the exception raised by
+          ``fut``, if any. If not given, the exception is re-raised in the
+          thread of this object, where it reaches ``sys.excepthook`` (e.g.
+          ``ExceptionDialog.excepthook``).
+
+        Cancelled futures don't call anything.
+        """
+        fut.add_done_callback(
+            lambda f: self._done.emit(f, on_result, on_error))
+
+    @staticmethod
+    def _handle_done(fut, on_result, on_error):
+        """
+        """
+        if fut.cancelled():
+            return
+        exc = fut.exception()
+        if exc is None:
+            on_result(fut.result())
+        elif on_error is not None:
+            on_error(exc)
+        else:
+            raise exc
+
+
+# #############################################################################
+# ## BACKGROUND LOADING
+# #############################################################################
+class PrefetchingLoader:
+    """
+    Runs a loading function on a pool of worker threads, and keeps the
+    results in a ``LRUCache``, indexed by path and modification time (so
+    that files modified on disk are loaded again). Usage example::
+
+      loader = PrefetchingLoader(lambda p: load_img_and_exif(p)[0])
+      loader.prefetch([next_path, prev_path])  # returns immediately
+      ...
+      arr = loader.get(next_path)  # instant, if already loaded
+
+    Only the thread that owns the loader (i.e. the GUI thread) is expected to
+    call its methods: the workers only run ``load_fn``.
+    """
+    def __init__(self, load_fn, max_items=3, num_workers=2):
+        """
+        :param load_fn: A function ``load_fn(path)`` returning the loaded
+          data. It will be called from worker threads.
+        :param max_items: Maximal number of loaded (or loading) paths to be
+          kept in the cache. Loads discarded before starting are cancelled.
+        :param num_workers: Number of worker threads.
+        """
+        self.load_fn = load_fn
+        self.cache = LRUCache(max_items,
+                              on_evict=lambda key, fut: fut.cancel())
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    @staticmethod
+    def _key(path):
+        """
+        :raises: ``OSError`` if the path doesn't exist.
+        """
+        return (os.path.abspath(path), os.stat(path).st_mtime_ns)
+
+    def submit(self, path):
+        """
+        :returns: A ``concurrent.futures.Future`` with the loading of the
+          given path. If it was already loading or loaded, no new load is
+          started (unless it failed or was cancelled).
+        """
+        key = self._key(path)
+        fut = self.cache.get(key)
+        if fut is None or fut.cancelled() or (
+                fut.done() and fut.exception() is not None):
+            fut = self.executor.submit(self.load_fn, path)
+            self.cache.put(key, fut)
+        return fut
+
+    def prefetch(self, paths):
+        """
+        Starts loading the given paths in the background, if not loaded
+        already. Nonexisting paths are ignored. Returns immediately.
+        """
+        keys = {}
+        for p in paths:
+            try:
+                keys[p] = self._key(p)
+            except OSError:
+                pass
+        # mark the cached ones as recently used first, so that they aren't
+        # discarded to make room for the new ones
+        for p, k in keys.items():
+            self.cache.get(k)
+        for p in keys:
+            self.submit(p)
+
+    def get(self, path):
+        """
+        :returns: The loaded data for the given path. Blocks until loaded,
+          unless it was already prefetched.
+        :raises: Any exception raised by ``load_fn``. Failed loads are not
+          kept in the cache.
+        """
+        fut = self.submit(path)
+        try:
+            return fut.result()
+        except Exception:
+            self.cache.pop(self._key(path))
+            raise
+
+    def clear(self):
+        """
+        Discards all loaded data, cancelling the pending loads.
+        """
+        for fut in self.cache.values():
+            fut.cancel()
+        self.cache.clear()
+
+    def shutdown(self):
+        """
+        Cancels the pending loads and stops the workers.
+        """
+        self.clear()
+        self.executor.shutdown(wait=False)
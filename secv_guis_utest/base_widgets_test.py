@@ -0,0 +1,192 @@
+# -*- coding:utf-8 -*-
+
+
+"""
+"""
+
+
+import os
+import tempfile
+import unittest
+from PySide2 import QtWidgets
+from PySide2 import QtCore
+from secv_guis.base_widgets import FileList, FileListModel, StemIndex
+
+
+APP = QtWidgets.QApplication.instance() or \
+    QtWidgets.QApplication(["SECV UTEST GUI"])
+
+
+class FileListTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        """
+        """
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.touch("b.png", "a.png", "c.PNG", "d.txt")
+        os.mkdir(os.path.join(self.tmpdir.name, "e.png"))
+        self.fl = FileList("test", extensions=[".png"])
+        self.fl.update_path(self.tmpdir.name)
+
+    def tearDown(self):
+        """
+        """
+        self.tmpdir.cleanup()
+
+    def touch(self, *names):
+        """
+        """
+        for n in names:
+            with open(os.path.join(self.tmpdir.name, n), "w"):
+                pass
+
+    def listed(self):
+        """
+        """
+        return list(self.fl.model.names)
+
+    def test_listing(self) -> None:
+        """
+        """
+        self.assertEqual(self.listed(), ["a.png", "b.png", "c.PNG"])
+        self.fl.update_path(self.tmpdir.name, selected_image="B")
+        self.assertEqual(self.listed(), ["b.png"])
+
+    def test_refresh(self) -> None:
+        """
+        Only changes are applied, keeping the selection and the filter.
+        """
+        self.fl.set_current_row(1)
+        self.touch("0.png", "bb.png", "f.png", "g.txt")
+        os.remove(os.path.join(self.tmpdir.name, "a.png"))
+        self.fl.refresh()
+        self.assertEqual(self.listed(),
+                         ["0.png", "b.png", "bb.png", "c.PNG", "f.png"])
+        self.assertEqual(self.fl.current_row(), 1)
+        self.assertEqual(self.fl.model.name(1), "b.png")
+        #
+        self.fl.update_path(self.tmpdir.name, selected_image="b.jpg")
+        self.touch("b.jpg_annot.png", "b_2.png", "bbb.png", "h.png")
+        self.fl.refresh()
+        self.assertEqual(self.listed(), ["b.jpg_annot.png", "b.png"])
+
+    def test_pairing(self) -> None:
+        """
+        Pairing with an image doesn't list the directory again.
+        """
+        self.touch("img_1.png", "img_1.png_annot.png", "IMG_1_pre.png",
+                   "img_10.png", "img_10.png_annot.png",
+                   "img_1_2.png_annot.png")
+        self.fl.refresh()
+        os.remove(os.path.join(self.tmpdir.name, "a.png"))
+        self.fl.set_selected_image("img_1.jpg")
+        self.assertEqual(self.listed(), ["img_1.png", "img_1.png_annot.png"])
+        # files named with a pair suffix after the stem are paired too
+        self.fl.set_pair_suffixes(["_pre.png"])
+        self.assertEqual(self.listed(), ["img_1.png", "img_1.png_annot.png",
+                                         "IMG_1_pre.png"])
+        self.fl.set_selected_image("img_10.png")
+        self.assertEqual(self.listed(), ["img_10.png", "img_10.png_annot.png"])
+        self.fl.set_selected_image(None)
+        self.assertIn("a.png", self.listed())
+        self.assertEqual(len(self.listed()), 9)
+        self.assertEqual(self.fl.paired_names("img_1.jpg"),
+                         {"img_1.png", "img_1.png_annot.png", "IMG_1_pre.png"})
+
+
+class StemIndexTestCase(unittest.TestCase):
+    """
+    """
+    def test_stems(self) -> None:
+        """
+        """
+        self.assertEqual(StemIndex.stems("Img_1.png_annot.png"),
+                         {"img_1", "img_1.png_annot", "img_1.png_annot.png"})
+        self.assertNotIn("img_1", StemIndex.stems("img_1_2.png_annot.png"))
+        self.assertEqual(StemIndex.stems(".hidden"), {".hidden"})
+        self.assertEqual(StemIndex.image_stem("IMG_1.tar.gz"), "img_1.tar")
+        #
+        index = StemIndex(["img_1.png", "img_10.png", "img_1.png_annot.png",
+                           "img_1_2.png"])
+        self.assertEqual(index.get("img_1"),
+                         {"img_1.png", "img_1.png_annot.png"})
+        index.remove("img_1.png")
+        index.add("img_1.npz")
+        self.assertEqual(index.get("img_1"),
+                         {"img_1.npz", "img_1.png_annot.png"})
+        self.assertEqual(index.get("img_2"), set())
+
+
+class FileListModelTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        """
+        """
+        self.names = ["img_{}.png".format(i) for i in range(2500)]
+        self.model = FileListModel()
+        self.model.set_names(reversed(self.names))
+
+    def test_natural_order(self) -> None:
+        """
+        """
+        self.assertEqual(self.model.names, self.names)
+        model = FileListModel()
+        model.set_names(["b10", "B2", "a", "b01", "b1", "c"])
+        self.assertEqual(model.names, ["a", "b01", "b1", "B2", "b10", "c"])
+
+    def test_fetch(self) -> None:
+        """
+        Rows are given to the view in batches, but names can be accessed and
+        modified regardless.
+        """
+        batch = FileListModel.FETCH_BATCH
+        self.assertEqual(self.model.rowCount(), batch)
+        self.assertTrue(self.model.canFetchMore())
+        self.assertEqual(self.model.row("img_2000.png"), 2000)
+        self.assertEqual(self.model.name(2000), "img_2000.png")
+        self.assertIsNone(self.model.name(len(self.names)))
+        self.assertEqual(self.model.row("nonexisting"), -1)
+        #
+        self.model.add_names(["img_0a.png", "img_2001a.png"])
+        self.model.remove_names(["img_3.png", "img_2002.png", "nonexisting"])
+        self.assertEqual(self.model.rowCount(), batch)
+        self.assertEqual(self.model.name(1), "img_0a.png")
+        self.assertEqual(self.model.row("img_2001a.png"), 2002)
+        while self.model.canFetchMore():
+            self.model.fetchMore()
+        self.assertEqual(self.model.rowCount(), len(self.model))
+        self.assertEqual(len(self.model), len(self.names))
+        self.model.add_names(["zzz"])
+        self.assertEqual(self.model.rowCount(), len(self.names) + 1)
+
+    def test_find(self) -> None:
+        """
+        """
+        self.assertEqual(self.model.find("IMG_99"),
+                         [99] + list(range(990, 1000)))
+        self.assertEqual(self.model.find("99.", prefix=True), [])
+        self.assertEqual(self.model.find("99."), [99, 199, 299, 399, 499,
+                                                  599, 699, 799, 899, 999,
+                                                  1099, 1199, 1299, 1399,
+                                                  1499, 1599, 1699, 1799,
+                                                  1899, 1999, 2099, 2199,
+                                                  2299, 2399, 2499])
+        self.assertEqual(self.model.find("img_249", prefix=True),
+                         [249] + list(range(2490, 2500)))
+        self.assertEqual(self.model.find(""), [])
+        # keyboard search of the view, beyond the fetched rows
+        matches = self.model.match(self.model.index(0), QtCore.Qt.DisplayRole,
+                                   "img_2499")
+        self.assertEqual([m.row() for m in matches], [2499])
+        view = QtWidgets.QListView()
+        view.setModel(self.model)
+        view.keyboardSearch("img_2498")
+        self.assertEqual(view.currentIndex().row(), 2498)
+        matches = self.model.match(self.model.index(0), QtCore.Qt.DisplayRole,
+                                   "_24", -1, QtCore.Qt.MatchContains)
+        self.assertEqual(len(matches), 1 + 10 + 100)
+        matches = self.model.match(self.model.index(0), QtCore.Qt.DisplayRole,
+                                   "img_24.png", -1, QtCore.Qt.MatchExactly)
+        self.assertEqual([m.row() for m in matches], [24])
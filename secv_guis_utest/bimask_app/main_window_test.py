@@ -5,9 +5,47 @@
 """
 
 
+import os
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from PySide2 import QtGui
-from secv_guis.bimask_app.main_window import MainWindow
+import numpy as np
+from PIL import Image
+from PySide2 import QtGui, QtWidgets
+from secv_guis.bimask_app.main_window import MainWindow, pmap_to_mask, \
+    PercentileThresholder, ranked_values, pick_paired_file, load_preannot
+from secv_guis.utils import save_bool_arr
+
+
+APP = QtWidgets.QApplication.instance() or \
+    QtWidgets.QApplication(["SECV UTEST GUI"])
+
+
+def process_events_while(condition, timeout=10):
+    """
+    Runs the Qt event loop until ``condition()`` is false, failing after
+    ``timeout`` seconds instead of hanging the test suite.
+    """
+    deadline = time.monotonic() + timeout
+    while condition():
+        assert time.monotonic() < deadline, "Timed out processing events"
+        APP.processEvents()
+
+
+def sorting_pmap_to_mask(pmap, upper_percentile, lower_percentile,
+                         percentile_max=100):
+    """
+    Reference implementation, sorting all values on every call.
+    """
+    pmap = np.array(pmap)
+    values = np.sort(pmap.flatten())
+    up = int((len(values) - 1) * upper_percentile / percentile_max)
+    lp = int((len(values) - 1) * lower_percentile / percentile_max)
+    pmap[pmap > values[up]] = 0
+    pmap[pmap < values[lp]] = 0
+    return pmap > 0
 
 
 class BasicMainWindowTestCase(unittest.TestCase):
@@ -24,3 +62,325 @@ class BasicMainWindowTestCase(unittest.TestCase):
         for k, v in self.mw.keymaps().items():
             self.assertIsInstance(k, str)
             self.assertIsInstance(v, QtGui.QKeySequence)
+
+    def test_mask_from_1bit_png(self) -> None:
+        """
+        PIL's 1-bit images (like the saved masks) have 255 as true bytes.
+        """
+        mask = np.random.RandomState(0).rand(30, 40) > 0.5
+        with tempfile.TemporaryDirectory() as tmpdir:
+            img_path = os.path.join(tmpdir, "img.png")
+            mask_path = os.path.join(tmpdir, "img.png_annot.png")
+            Image.fromarray(np.zeros((30, 40, 3), dtype=np.uint8)).save(
+                img_path)
+            Image.fromarray(mask).save(mask_path)
+            self.assertEqual(np.asarray(Image.open(mask_path)).view(
+                np.uint8).max(), 255)
+            view = self.mw.graphics_view
+            self.assertTrue(view.new_image(img_path))
+            process_events_while(lambda: view.is_loading)
+            view.mask_from_path(mask_path, (255, 0, 0, 100))
+        self.assertTrue(view.annot_pmi.binary)
+        self.assertEqual(view.annot_pmi.as_bool_arr().sum(), mask.sum())
+
+    def test_loading(self) -> None:
+        """
+        Masks can't be edited while the image loads, and a failed load
+        leaves nothing to be edited or saved.
+        """
+        view = self.mw.graphics_view
+        with tempfile.TemporaryDirectory() as tmpdir:
+            img_path = os.path.join(tmpdir, "img.jpg")
+            Image.fromarray(np.random.randint(
+                0, 255, (300, 400, 3), dtype=np.uint8)).save(img_path)
+            # keep the image loading until released
+            release = threading.Event()
+            self.addCleanup(release.set)
+            for _ in range(2):
+                view.img_loader.executor.submit(release.wait)
+            self.assertTrue(view.new_image(img_path))
+            self.assertTrue(view.is_loading)
+            self.mw.paint_form.current_button_idx = 1
+            view.clickdrag_action(20, 20)
+            view._finish_clickdrag_action()
+            self.assertFalse(view.annot_pmi.as_bool_arr().any())
+            self.assertEqual(view.saved_state_tracker.num_edits, 0)
+            with self.assertRaises(AssertionError):
+                view.mask_from_path(img_path, (255, 0, 0, 100))
+            release.set()
+            process_events_while(lambda: view.is_loading)
+            view.clickdrag_action(20, 20)
+            view._finish_clickdrag_action()
+            self.assertTrue(view.annot_pmi.as_bool_arr().any())
+            # truncated JPEG: the header can be read, but not the pixels
+            with open(img_path, "rb") as f:
+                data = f.read()
+            with open(img_path, "wb") as f:
+                f.write(data[:len(data) // 2])
+            view.saved_state_tracker.save()
+            errors = []
+            excepthook, sys.excepthook = sys.excepthook, \
+                lambda t, v, tb: errors.append(v)
+            try:
+                self.assertTrue(view.new_image(img_path))
+                process_events_while(lambda: view.is_loading)
+            finally:
+                sys.excepthook = excepthook
+        self.assertTrue(errors)
+        self.assertIsNone(view.shape)
+        self.assertIsNone(view.annot_pmi)
+        self.assertIsNone(view.saved_state_tracker)
+        self.assertEqual(len(view.scene().items()), 0)
+
+
+class PercentileThresholderTestCase(unittest.TestCase):
+    """
+    Test that the thresholding engine matches the sort-based reference.
+    """
+    SHAPE = (123, 321)
+    PERCENTILE_PAIRS = [(100, 90), (100, 0), (50, 50), (73, 12), (0, 0),
+                        (10, 90)]
+
+    def setUp(self):
+        """
+        """
+        self.pmaps = [np.random.rand(*self.SHAPE),
+                      np.random.randint(0, 5, self.SHAPE).astype(np.float32),
+                      np.random.randn(*self.SHAPE),
+                      np.random.randn(*self.SHAPE).astype(np.float16),
+                      np.random.randint(0, 256, self.SHAPE).astype(np.uint8),
+                      np.random.randint(-9, 9, self.SHAPE).astype(np.int16)]
+
+    def test_ranked_values(self) -> None:
+        """
+        """
+        ranks = [0, 1, 17, 4000, 4000, self.SHAPE[0] * self.SHAPE[1] - 1]
+        pmaps = self.pmaps + [np.array([np.nan, -0.0, 0.0, np.inf, -np.inf,
+                                        1.5, np.nan], dtype=np.float16)]
+        for pmap in pmaps:
+            sorted_vals = np.sort(pmap, axis=None)
+            rks = [min(r, pmap.size - 1) for r in ranks]
+            vals = ranked_values(pmap, rks, chunk_size=1000)
+            self.assertEqual(vals.dtype, pmap.dtype)
+            np.testing.assert_array_equal(vals, sorted_vals[rks])
+
+    def test_pmap_to_mask(self) -> None:
+        """
+        """
+        for pmap in self.pmaps:
+            original = pmap.copy()
+            for up, lp in self.PERCENTILE_PAIRS:
+                m = pmap_to_mask(pmap, up, lp)
+                ref = sorting_pmap_to_mask(pmap, up, lp)
+                self.assertTrue((m == ref).all())
+            self.assertTrue((pmap == original).all())
+
+    def test_thresholder(self) -> None:
+        """
+        """
+        for pmap in self.pmaps:
+            thresholder = PercentileThresholder(pmap)
+            for up, lp in self.PERCENTILE_PAIRS:
+                m = thresholder.mask(up, lp)
+                self.assertEqual(m.shape, pmap.shape)
+                ref = sorting_pmap_to_mask(pmap, up, lp)
+                self.assertTrue((m == ref).all())
+
+    def test_quantized_thresholding(self) -> None:
+        """
+        Thresholding the quantized map via lookup table must match the mask.
+        """
+        for pmap in self.pmaps:
+            thresholder = PercentileThresholder(pmap)
+            for offset in (0, 2):
+                codes = thresholder.quantize(offset, chunk_size=1000)
+                self.assertEqual(codes.dtype, np.uint8)
+                for up, lp in self.PERCENTILE_PAIRS:
+                    lut = thresholder.code_lut(up, lp, offset)
+                    m = thresholder.mask(up, lp)
+                    self.assertTrue((lut[codes] == m).all())
+
+    def test_memory_mapped(self) -> None:
+        """
+        Memory-mapped maps are thresholded like loaded ones, and can be
+        released after quantization.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "pmap.npy")
+            np.save(path, self.pmaps[3])
+            pmap = np.load(path, mmap_mode="r")
+            thresholder = PercentileThresholder(pmap)
+            codes = thresholder.quantize(2)
+            thresholder.release_pmap()
+            del pmap
+            for up, lp in self.PERCENTILE_PAIRS:
+                ref = sorting_pmap_to_mask(self.pmaps[3], up, lp)
+                lut = thresholder.code_lut(up, lp, 2)
+                self.assertTrue((lut[codes] == ref).all())
+
+    def test_load_preannot(self) -> None:
+        """
+        Preannotation formats are recognized regardless of the extension
+        case.
+        """
+        pmap = self.pmaps[0]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            npy_path = os.path.join(tmpdir, "pmap.NPY")
+            npz_path = os.path.join(tmpdir, "pmap.Npz")
+            with open(npy_path, "wb") as f:
+                np.save(f, pmap)
+            with open(npz_path, "wb") as f:
+                np.savez(f, entropy=pmap)
+            for path in (npy_path, npz_path):
+                thresholder, codes = load_preannot(path)
+                for up, lp in self.PERCENTILE_PAIRS:
+                    ref = sorting_pmap_to_mask(pmap, up, lp)
+                    lut = thresholder.code_lut(up, lp, 2)
+                    self.assertTrue((lut[codes] == ref).all())
+
+
+class PairingTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        """
+        """
+        self.tmpdir = tempfile.TemporaryDirectory()
+        for n in ("img_1.png", "img_1.npz", "img_1.png_preannot.png",
+                  "img_1.png_annot.npz", "img_1_old.png", "img_2.png",
+                  "img_2_annot.png", "img_3.png", "img_5.png", "img_5.npz",
+                  "img_6.png", "img_6.png_points.json"):
+            with open(os.path.join(self.tmpdir.name, n), "w"):
+                pass
+        self.mw = MainWindow()
+        for flist in (self.mw.file_lists.img_list,
+                      self.mw.file_lists.mask_list,
+                      self.mw.file_lists.preannot_list):
+            flist.update_path(self.tmpdir.name)
+
+    def tearDown(self):
+        """
+        """
+        self.tmpdir.cleanup()
+
+    def test_pick_paired_file(self) -> None:
+        """
+        """
+        self.assertEqual(pick_paired_file({"a", "B"}, ["c", "b", "a"]), "B")
+        self.assertIsNone(pick_paired_file({"a"}, ["c"]))
+        self.assertIsNone(pick_paired_file(set(), ["a"]))
+
+    def test_paired_paths(self) -> None:
+        """
+        Only masks named like the saved ones, and preannotations named like
+        the image, are paired.
+        """
+        def paired(basename):
+            return tuple(None if p is None else os.path.basename(p)
+                         for p in self.mw._paired_paths(basename))
+        self.assertEqual(paired("img_1.png"),
+                         ("img_1.png_annot.npz", "img_1.npz"))
+        self.assertEqual(paired("img_2.png"), ("img_2_annot.png", None))
+        self.assertEqual(paired("img_3.png"), (None, None))
+        # files that can't be loaded as masks are not taken as masks
+        self.assertEqual(paired("img_5.png"), (None, "img_5.npz"))
+        self.assertEqual(paired("img_6.png"), (None, None))
+
+    def test_paired_paths_other_image(self) -> None:
+        """
+        The files of img_1_2 are not paired with img_1, even if img_1 has
+        none, and they are in separate folders.
+        """
+        for folder, name in (("masks", "img_1_2.png_annot.png"),
+                             ("pre", "img_1_2.npz")):
+            os.mkdir(os.path.join(self.tmpdir.name, folder))
+            with open(os.path.join(self.tmpdir.name, folder, name), "w"):
+                pass
+        self.mw.file_lists.mask_list.update_path(
+            os.path.join(self.tmpdir.name, "masks"))
+        self.mw.file_lists.preannot_list.update_path(
+            os.path.join(self.tmpdir.name, "pre"))
+        self.assertEqual(self.mw._paired_paths("img_1.png"), (None, None))
+        self.assertEqual(
+            [os.path.basename(p) for p in self.mw._paired_paths(
+                "img_1_2.png")], ["img_1_2.png_annot.png", "img_1_2.npz"])
+
+    def test_pair_thresholds(self) -> None:
+        """
+        Auto-loaded preannotations are thresholded like the sliders show.
+        """
+        img_path = os.path.join(self.tmpdir.name, "img_4.png")
+        Image.fromarray(np.zeros((30, 40, 3), dtype=np.uint8)).save(img_path)
+        pmap = np.random.RandomState(0).rand(30, 40)
+        np.save(os.path.join(self.tmpdir.name, "img_4.npy"), pmap)
+        for flist in (self.mw.file_lists.img_list,
+                      self.mw.file_lists.preannot_list):
+            flist.refresh()
+        upper_sl, lower_sl = self.mw.paint_form._sliders[:2]
+        upper_sl.setValue(80)
+        lower_sl.setValue(30)
+        self.assertEqual(self.mw.preannot_thresholds(), (80, 30))
+        view = self.mw.graphics_view
+        view.img_loader.submit(img_path).result()
+        self.mw.auto_load_action.setChecked(True)
+        self.assertTrue(self.mw._handle_img_selection("img_4.png"))
+        process_events_while(lambda: view._pair_request is not None)
+        self.assertTrue((view.preannot_pmi.as_bool_arr() ==
+                         pmap_to_mask(pmap, 80, 30)).all())
+
+    def test_pair_errors(self) -> None:
+        """
+        Paired files that fail to apply are reported, and don't prevent the
+        image from being selected.
+        """
+        img_path = os.path.join(self.tmpdir.name, "img_4.png")
+        Image.fromarray(np.zeros((30, 40, 3), dtype=np.uint8)).save(img_path)
+        pmap_path = os.path.join(self.tmpdir.name, "img_4.npy")
+        np.save(pmap_path, np.random.rand(3, 4))
+        for flist in (self.mw.file_lists.img_list,
+                      self.mw.file_lists.preannot_list):
+            flist.refresh()
+        view = self.mw.graphics_view
+        # already loaded pairs are applied (and fail) within new_image
+        view.img_loader.submit(img_path).result()
+        view.preannot_loader.submit(pmap_path).result()
+        errors = []
+        excepthook, sys.excepthook = sys.excepthook, \
+            lambda t, v, tb: errors.append(v)
+        try:
+            self.mw.auto_load_action.setChecked(True)
+            self.assertTrue(self.mw._handle_img_selection("img_4.png"))
+        finally:
+            sys.excepthook = excepthook
+        self.assertEqual(self.mw.current_img_basename, "img_4.png")
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], ValueError)
+
+    def test_unapplied_pairs(self) -> None:
+        """
+        Pairs loaded after an edit are kept, and applied on request.
+        """
+        img_path = os.path.join(self.tmpdir.name, "img_4.png")
+        Image.fromarray(np.zeros((30, 40, 3), dtype=np.uint8)).save(img_path)
+        mask = np.random.RandomState(0).rand(30, 40) > 0.5
+        save_bool_arr(
+            mask, os.path.join(self.tmpdir.name, "img_4.png_annot.npz"))
+        for flist in (self.mw.file_lists.img_list,
+                      self.mw.file_lists.mask_list):
+            flist.refresh()
+        view = self.mw.graphics_view
+        # the mask loads only after the edit
+        release = threading.Event()
+        self.addCleanup(release.set)
+        for _ in range(2):
+            view.mask_loader.executor.submit(release.wait)
+        self.mw.auto_load_action.setChecked(True)
+        self.assertTrue(self.mw._handle_img_selection("img_4.png"))
+        view.saved_state_tracker.edit()
+        release.set()
+        process_events_while(lambda: view._pair_request is not None)
+        self.assertFalse(view.annot_pmi.as_bool_arr().any())
+        self.assertTrue(self.mw.statusBar().currentMessage())
+        self.assertTrue(view.apply_pairs())
+        self.assertTrue((view.annot_pmi.as_bool_arr() == mask).all())
+        self.assertFalse(view.apply_pairs())
@@ -0,0 +1,164 @@
+# -*- coding:utf-8 -*-
+
+
+"""
+"""
+
+
+import unittest
+import numpy as np
+from PySide2 import QtWidgets
+from secv_guis.masked_scene import IndexedMaskItem
+from secv_guis.commands import ArrayPatch, DrawCommand, EraseCommand, \
+    DrawOverlappingCommand, MemoryBudgetUndoStack
+
+
+APP = QtWidgets.QApplication.instance() or \
+    QtWidgets.QApplication(["SECV UTEST GUI"])
+
+
+class ArrayPatchTestCase(unittest.TestCase):
+    """
+    """
+    def test_paste(self):
+        """
+        """
+        rng = np.random.RandomState(0)
+        arr = rng.randint(0, 256, (30, 40)).astype(np.uint8)
+        for level in (0, 1, 9):
+            patch = ArrayPatch(arr[5:17, 3:33], 3, 5, level)
+            dst = np.zeros_like(arr)
+            patch.paste(dst)
+            self.assertTrue((dst[5:17, 3:33] == arr[5:17, 3:33]).all())
+            dst[5:17, 3:33] = 0
+            self.assertFalse(dst.any())
+
+    def test_compression(self):
+        """
+        """
+        arr = np.zeros((500, 500), dtype=np.uint8)
+        self.assertEqual(ArrayPatch(arr, 0, 0, 0).nbytes(), arr.nbytes)
+        self.assertLess(ArrayPatch(arr, 0, 0, 1).nbytes(), arr.nbytes // 100)
+
+
+class DrawCommandTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        """
+        """
+        self.rng = np.random.RandomState(0)
+        self.codes = (self.rng.rand(150, 201) > 0.5).astype(np.uint8)
+        self.stack = MemoryBudgetUndoStack()
+
+    def stroke(self, cmd, num_dabs=10):
+        """
+        """
+        for x, y in self.rng.rand(num_dabs, 2) * (201, 150):
+            cmd.action(x, y)
+        cmd.finish(self.stack)
+
+    def test_undo_redo(self):
+        """
+        """
+        item = IndexedMaskItem(self.codes, (255, 0, 0, 100), num_levels=3)
+        states = [item.arr.copy()]
+        for cmd in (DrawCommand(item, 30), EraseCommand(item, 20),
+                    DrawCommand(item, 5)):
+            self.stroke(cmd)
+            states.append(item.arr.copy())
+        self.assertEqual(self.stack.count(), 3)
+        for st in reversed(states[:-1]):
+            self.stack.undo()
+            self.assertTrue((item.arr == st).all())
+            self.assertTrue((item.levels[2] == st[::4, ::4]).all())
+        for st in states[1:]:
+            self.stack.redo()
+            self.assertTrue((item.arr == st).all())
+
+    def test_binary_view(self):
+        """
+        """
+        item = IndexedMaskItem(self.codes, (255, 0, 0, 100))
+        self.assertTrue(item.binary)
+        mask = item.as_bool_arr()
+        self.assertTrue((mask == self.codes.astype(np.bool)).all())
+        self.stroke(EraseCommand(item, 50))
+        self.assertTrue((mask == item.arr.astype(np.bool)).all())
+        self.assertFalse(mask.flags.writeable)
+        #
+        lut = np.zeros(256, dtype=np.bool)
+        lut[5] = True
+        item = IndexedMaskItem(self.codes * 5, (255, 0, 0, 100), code_lut=lut)
+        self.assertFalse(item.binary)
+        self.assertTrue(
+            (item.as_bool_arr() == self.codes.astype(np.bool)).all())
+
+    def test_no_change(self):
+        """
+        """
+        item = IndexedMaskItem(np.zeros_like(self.codes), (255, 0, 0, 100))
+        cmd = EraseCommand(item, 30)
+        self.stroke(cmd)
+        self.assertFalse(cmd.changed)
+        self.assertEqual(self.stack.count(), 0)
+        # repeating a stroke changes nothing
+        for changed in (True, False):
+            self.rng = np.random.RandomState(1)
+            cmd = DrawCommand(item, 30)
+            self.stroke(cmd)
+            self.assertEqual(cmd.changed, changed)
+        self.assertEqual(self.stack.count(), 1)
+
+    def test_interpolation(self):
+        """
+        """
+        item = IndexedMaskItem(np.zeros_like(self.codes), (255, 0, 0, 100))
+        cmd = DrawCommand(item, 6)
+        cmd.action(10, 10)
+        cmd.action(190.5, 140.5)
+        cmd.action(190.7, 140.7)  # too close, pending until finish
+        cmd.finish(self.stack)
+        mask = item.as_bool_arr()
+        for t in np.linspace(0, 1, 1000):
+            self.assertTrue(mask[int(10 + 130 * t), int(10 + 180 * t)])
+        self.assertFalse(mask[140, 10] or mask[10, 190])
+        # the painted area is that of a stroke with closely spaced positions
+        item2 = IndexedMaskItem(np.zeros_like(self.codes), (255, 0, 0, 100))
+        cmd2 = DrawCommand(item2, 6, spacing=0.01)
+        for t in np.linspace(0, 1, 1000):
+            cmd2.action(10 + 180.5 * t, 10 + 130.5 * t)
+        cmd2.finish(self.stack)
+        diff = (mask != item2.as_bool_arr()).sum()
+        self.assertLess(diff, 0.1 * mask.sum())
+
+    def test_overlapping(self):
+        """
+        """
+        ref = IndexedMaskItem(self.codes, (255, 0, 0, 100))
+        item = IndexedMaskItem(np.zeros_like(self.codes), (0, 255, 0, 100))
+        free_item = IndexedMaskItem(np.zeros_like(self.codes), (0, 0, 0, 1))
+        self.rng = np.random.RandomState(1)
+        self.stroke(DrawOverlappingCommand(item, ref, 25))
+        self.rng = np.random.RandomState(1)
+        self.stroke(DrawCommand(free_item, 25))
+        self.assertTrue(item.as_bool_arr().any())
+        self.assertTrue((item.as_bool_arr() ==
+                         (free_item.as_bool_arr() & ref.as_bool_arr())).all())
+
+    def test_budget(self):
+        """
+        """
+        item = IndexedMaskItem(self.codes, (255, 0, 0, 100))
+        original = item.arr.copy()
+        for _ in range(5):
+            self.stroke(DrawCommand(item, 10))
+        total = self.stack.nbytes()
+        self.stack.budget_bytes = total - 1
+        self.stroke(EraseCommand(item, 10))
+        self.assertLessEqual(self.stack.nbytes(), self.stack.budget_bytes)
+        # evicted commands can't be undone and are removed when reached
+        while self.stack.canUndo():
+            self.stack.undo()
+        self.assertLess(self.stack.count(), 6)
+        self.assertFalse((item.arr == original).all())
@@ -6,15 +6,22 @@ https://docs.python.org/3/library/unittest.html#assert-methods
 """
 
 
+import os
+import tempfile
 import unittest
+from unittest import mock
 import numpy as np
+from PIL import Image
 from PySide2 import QtGui, QtWidgets
-from secv_guis.utils import RandomColorGenerator
+from secv_guis.utils import RandomColorGenerator, load_img_and_exif, \
+    read_img_shape, load_npz_array, bool_arr_to_rle, rle_to_bool_arr, \
+    save_bool_arr, load_bool_arr, UniqueFilenameAllocator
 from secv_guis.utils import rgb_arr_to_rgb_pixmap, bool_arr_to_rgba_pixmap, \
     pixmap_to_arr
 
 
-APP = QtWidgets.QApplication(["SECV UTEST GUI"])
+APP = QtWidgets.QApplication.instance() or \
+    QtWidgets.QApplication(["SECV UTEST GUI"])
 
 
 class RandomColorGeneratorTestCase(unittest.TestCase):
@@ -58,6 +65,19 @@ class NumpyAndPixmapTestCase(unittest.TestCase):
                                    img_format=QtGui.QImage.Format_RGB888)
         self.assertTrue((self.rgb_arr == re_rgb_arr).all())
 
+    def test_rgb_array_odd_width(self) -> None:
+        """
+        Scanlines of odd widths are padded by Qt, but not by numpy.
+        """
+        rgb_arr = np.ascontiguousarray(self.rgb_arr[:, :333])
+        rgb_pm = rgb_arr_to_rgb_pixmap(rgb_arr)
+        for fmt in (QtGui.QImage.Format_RGB888, QtGui.QImage.Format_Indexed8,
+                    QtGui.QImage.Format_Grayscale8):
+            re_arr = pixmap_to_arr(rgb_pm, img_format=fmt)
+            self.assertEqual(re_arr.shape[:2], rgb_arr.shape[:2])
+            if fmt == QtGui.QImage.Format_RGB888:
+                self.assertTrue((rgb_arr == re_arr).all())
+
     def test_mask_array(self) -> None:
         """
         """
@@ -66,3 +86,226 @@ class NumpyAndPixmapTestCase(unittest.TestCase):
             mask_pm, img_format=QtGui.QImage.Format_RGB888)[:, :, 0] > 0
         #
         self.assertTrue((self.mask == re_mask_arr).all())
+
+    def test_mask_array_color(self) -> None:
+        """
+        """
+        rgba = (12, 34, 56, 78)
+        mask = self.mask[:37, :501]  # odd width, non-contiguous view
+        mask_pm = bool_arr_to_rgba_pixmap(mask, rgba=rgba)
+        re_arr = pixmap_to_arr(mask_pm,
+                               img_format=QtGui.QImage.Format_RGBA8888)
+        self.assertTrue((mask == (re_arr[:, :, 3] > 0)).all())
+        # pixmaps may be premultiplied, so colors can be slightly off
+        diff = re_arr[mask].astype(np.int16) - rgba
+        self.assertTrue((diff[:, 3] == 0).all())
+        self.assertTrue((np.abs(diff) <= 4).all())
+        self.assertFalse(re_arr[~mask].any())
+
+    def test_mask_array_pil(self) -> None:
+        """
+        PIL's 1-bit images are bool arrays with 255 as true bytes.
+        """
+        mask = np.asarray(Image.fromarray(self.mask[:50, :60]))
+        self.assertEqual(mask.view(np.uint8).max(), 255)
+        mask_pm = bool_arr_to_rgba_pixmap(mask, rgba=(255, 255, 255, 255))
+        re_arr = pixmap_to_arr(mask_pm,
+                               img_format=QtGui.QImage.Format_RGBA8888)
+        self.assertTrue((mask == (re_arr[:, :, 3] > 0)).all())
+
+
+class ImageLoadingTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        """
+        """
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.arr = np.random.randint(0, 256, size=(20, 30, 3), dtype=np.uint8)
+
+    def tearDown(self):
+        """
+        """
+        self.tmpdir.cleanup()
+
+    def save_with_orientation(self, orientation):
+        """
+        """
+        path = os.path.join(self.tmpdir.name,
+                            "{}.png".format(orientation))
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        Image.fromarray(self.arr).save(path, exif=exif.tobytes())
+        return path
+
+    def test_orientation(self) -> None:
+        """
+        Images are loaded upright, as displayed by image viewers.
+        """
+        expected = {1: self.arr,
+                    2: self.arr[:, ::-1],
+                    3: self.arr[::-1, ::-1],
+                    4: self.arr[::-1],
+                    5: self.arr.transpose(1, 0, 2),
+                    6: np.rot90(self.arr, -1),
+                    7: self.arr.transpose(1, 0, 2)[::-1, ::-1],
+                    8: np.rot90(self.arr, 1)}
+        for orientation, arr in expected.items():
+            path = self.save_with_orientation(orientation)
+            img, exif = load_img_and_exif(path)
+            self.assertTrue((img == arr).all())
+            self.assertEqual(exif[0x0112], orientation)
+            self.assertEqual(read_img_shape(path), arr.shape[:2])
+        img, exif = load_img_and_exif(path, full_exif=True)
+        self.assertEqual(exif["Image Orientation"].values[0], 8)
+
+
+class NpzLoadingTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        """
+        """
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.arrs = {"f16": np.random.rand(20, 30).astype(np.float16),
+                     "fortran": np.asfortranarray(np.random.rand(5, 7)),
+                     "empty": np.zeros((0, 3), dtype=np.uint8)}
+
+    def tearDown(self):
+        """
+        """
+        self.tmpdir.cleanup()
+
+    def test_load(self) -> None:
+        """
+        Stored arrays are memory-mapped, compressed ones are loaded.
+        """
+        for save_fn, mapped in ((np.savez, True),
+                                (np.savez_compressed, False)):
+            path = os.path.join(self.tmpdir.name, "arrs.npz")
+            save_fn(path, **self.arrs)
+            for name, arr in self.arrs.items():
+                loaded = load_npz_array(path, name)
+                self.assertEqual(isinstance(loaded, np.memmap), mapped)
+                self.assertEqual(loaded.dtype, arr.dtype)
+                np.testing.assert_array_equal(loaded, arr)
+                del loaded
+                loaded = load_npz_array(path, name, mmap_mode=None)
+                self.assertNotIsInstance(loaded, np.memmap)
+            with self.assertRaises(KeyError):
+                load_npz_array(path, "nonexisting")
+
+
+class MaskIOTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        """
+        """
+        self.tmpdir = tempfile.TemporaryDirectory()
+        rng = np.random.RandomState(0)
+        self.masks = [rng.rand(37, 51) > 0.5,
+                      np.ones((10, 3), dtype=np.bool),
+                      np.zeros((4, 9), dtype=np.bool),
+                      (rng.rand(200, 300) > 0.5)[::2, 1::3]]
+
+    def tearDown(self):
+        """
+        """
+        self.tmpdir.cleanup()
+
+    def test_rle(self) -> None:
+        """
+        """
+        mask = np.array([[0, 1, 1], [0, 1, 0]], dtype=np.bool)
+        self.assertEqual(bool_arr_to_rle(mask),
+                         {"size": [2, 3], "counts": [2, 3, 1]})
+        self.assertEqual(bool_arr_to_rle(~mask)["counts"], [0, 2, 3, 1])
+        for mask in self.masks:
+            self.assertTrue(
+                (rle_to_bool_arr(bool_arr_to_rle(mask)) == mask).all())
+
+    def test_round_trip(self) -> None:
+        """
+        """
+        for ext in (".png", ".PNG", ".npz", ".json", ".bmp"):
+            for i, mask in enumerate(self.masks):
+                path = os.path.join(self.tmpdir.name, str(i) + ext)
+                save_bool_arr(mask, path, png_compress_level=0)
+                self.assertTrue(os.path.isfile(path))
+                loaded = load_bool_arr(path)
+                self.assertEqual(loaded.dtype, np.bool)
+                self.assertLessEqual(loaded.view(np.uint8).max(initial=0), 1)
+                self.assertEqual(loaded.shape, mask.shape)
+                self.assertTrue((loaded == mask).all())
+
+
+class UniqueFilenameTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        """
+        """
+        self.tmpdir = tempfile.TemporaryDirectory()
+        for n in ("a.png", "a_(1).png", "a_(7).png", "a_(x).png",
+                  "a.json", "b_(3).png"):
+            with open(self.path(n), "w"):
+                pass
+
+    def tearDown(self):
+        """
+        """
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        """
+        """
+        return os.path.join(self.tmpdir.name, name)
+
+    def test_allocate(self) -> None:
+        """
+        Paths follow the highest suffix in the folder, and are reserved.
+        """
+        allocate = UniqueFilenameAllocator()
+        self.assertEqual(allocate(self.path("a.png")), self.path("a_(8).png"))
+        self.assertTrue(os.path.isfile(self.path("a_(8).png")))
+        self.assertEqual(allocate(self.path("a.png")), self.path("a_(9).png"))
+        self.assertEqual(allocate(self.path("a.json")),
+                         self.path("a_(1).json"))
+        self.assertEqual(allocate(self.path("b.png")), self.path("b.png"))
+        self.assertEqual(allocate(self.path("b.png")), self.path("b_(4).png"))
+        self.assertEqual(allocate(self.path("a_(1).png")),
+                         self.path("a_(1)_(1).png"))
+        with self.assertRaises(FileNotFoundError):
+            allocate(self.path("nonexisting/c.png"))
+
+    def test_listed_once(self) -> None:
+        """
+        Each folder is listed once, regardless of the number of names.
+        """
+        allocate = UniqueFilenameAllocator()
+        with mock.patch("os.scandir", wraps=os.scandir) as scandir:
+            for name in ("a.png", "b.png", "c.png", "a.png", "a.json"):
+                allocate(self.path(name))
+        self.assertEqual(scandir.call_count, 1)
+
+    def test_concurrent(self) -> None:
+        """
+        Paths taken after listing the folder (e.g. by other allocators) are
+        skipped.
+        """
+        alloc1, alloc2 = UniqueFilenameAllocator(), UniqueFilenameAllocator()
+        self.assertEqual(alloc1(self.path("a.png")), self.path("a_(8).png"))
+        self.assertEqual(alloc2(self.path("a.png")), self.path("a_(9).png"))
+        self.assertEqual(alloc1(self.path("a.png")), self.path("a_(10).png"))
+        with open(self.path("a_(11).png"), "w"):
+            pass
+        self.assertEqual(alloc1(self.path("a.png")), self.path("a_(12).png"))
+        #
+        alloc3 = UniqueFilenameAllocator(max_iters=2)
+        self.assertEqual(alloc3(self.path("b.png")), self.path("b.png"))
+        for n in ("b_(4).png", "b_(5).png"):
+            with open(self.path(n), "w"):
+                pass
+        with self.assertRaises(RuntimeError):
+            alloc3(self.path("b.png"))
@@ -0,0 +1,130 @@
+# -*- coding:utf-8 -*-
+
+
+"""
+"""
+
+
+import os
+import time
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from PySide2 import QtWidgets
+from secv_guis.workers import LRUCache, PrefetchingLoader, FutureSignaler
+
+
+APP = QtWidgets.QApplication.instance() or \
+    QtWidgets.QApplication(["SECV UTEST GUI"])
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    """
+    """
+    def test_eviction(self):
+        """
+        """
+        evicted = []
+        cache = LRUCache(3, on_evict=lambda k, v: evicted.append(k))
+        for i in range(3):
+            cache.put(i, str(i))
+        self.assertEqual(cache.get(0), "0")  # 1 is now the least recent
+        cache.put(3, "3")
+        self.assertEqual(evicted, [1])
+        self.assertNotIn(1, cache)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.values(), ["2", "0", "3"])
+        self.assertEqual(cache.pop(2), "2")
+        self.assertEqual(evicted, [1])
+        self.assertIsNone(cache.get(2))
+
+
+class PrefetchingLoaderTestCase(unittest.TestCase):
+    """
+    """
+    def setUp(self):
+        """
+        """
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.paths = []
+        for i in range(5):
+            p = os.path.join(self.tmpdir.name, "{}.txt".format(i))
+            with open(p, "w") as f:
+                f.write(str(i))
+            self.paths.append(p)
+        self.calls = []
+
+    def tearDown(self):
+        """
+        """
+        self.tmpdir.cleanup()
+
+    def load(self, path):
+        """
+        """
+        self.calls.append(path)
+        with open(path) as f:
+            return f.read()
+
+    def test_prefetch(self):
+        """
+        """
+        loader = PrefetchingLoader(self.load, max_items=3)
+        loader.prefetch(self.paths[:2] + ["nonexisting_path"])
+        self.assertEqual(loader.get(self.paths[0]), "0")
+        self.assertEqual(loader.get(self.paths[1]), "1")
+        self.assertEqual(len(self.calls), 2)
+        # neighbours already cached are kept when prefetching new ones
+        loader.prefetch([self.paths[2], self.paths[0]])
+        loader.prefetch([self.paths[3], self.paths[0]])
+        self.assertEqual(loader.get(self.paths[0]), "0")
+        self.assertEqual(loader.get(self.paths[3]), "3")
+        self.assertEqual(sorted(self.calls), self.paths[:4])
+        loader.shutdown()
+
+    def test_modified_file(self):
+        """
+        """
+        loader = PrefetchingLoader(self.load)
+        self.assertEqual(loader.get(self.paths[0]), "0")
+        time.sleep(0.01)
+        with open(self.paths[0], "w") as f:
+            f.write("new")
+        os.utime(self.paths[0], ns=(time.time_ns(), time.time_ns() + 10**9))
+        self.assertEqual(loader.get(self.paths[0]), "new")
+        loader.shutdown()
+
+    def test_errors(self):
+        """
+        """
+        loader = PrefetchingLoader(lambda p: 1 / 0)
+        for _ in range(2):  # failed loads are retried
+            with self.assertRaises(ZeroDivisionError):
+                loader.get(self.paths[0])
+        self.assertEqual(len(loader.cache), 0)
+        loader.shutdown()
+
+
+class FutureSignalerTestCase(unittest.TestCase):
+    """
+    """
+    def test_callbacks(self):
+        """
+        """
+        results, errors = [], []
+        signaler = FutureSignaler()
+        with ThreadPoolExecutor(1) as executor:
+            blocker = executor.submit(time.sleep, 0.1)
+            fut_ok = executor.submit(lambda: 123)
+            fut_err = executor.submit(lambda: 1 / 0)
+            fut_cancel = executor.submit(lambda: 456)
+            self.assertTrue(fut_cancel.cancel())
+            for fut in (fut_ok, fut_err, fut_cancel):
+                signaler.watch(fut, results.append, errors.append)
+            blocker.result()
+        # callbacks are queued until the event loop runs
+        self.assertEqual(results, [])
+        APP.processEvents()
+        self.assertEqual(results, [123])
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], ZeroDivisionError)